@@ -0,0 +1,339 @@
+# Latency and allocation benchmark for the image-save metadata hook.
+#
+# Drives scripts/image_metadata.add_resource_metadata with synthetic
+# processing objects and stub webui modules, so it runs without webui:
+#
+#   python benchmarks/bench_image_metadata.py --embeddings 2000 --loras 8 --adetailer 2 --hires
+#
+# --batch-size sets how many images share one processing object, like the
+# images of one generation batch. --cold drops the hook's caches before
+# every image to measure the worst case.
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ExtraNetworkParams:
+
+    def __init__(self, items):
+        self.items = items
+        self.positional = items
+
+
+class CheckpointInfo:
+
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+
+
+class NetworkOnDisk:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+class StableDiffusionProcessingTxt2Img:
+    pass
+
+
+re_extra_net = re.compile(r"<(\w+):([^>]+)>")
+re_attention = re.compile(r"\(([^():]+):([\d.]+)\)")
+
+
+def parse_prompt(prompt):
+    found = {}
+
+    def found_network(match):
+        found.setdefault(match.group(1), []).append(
+            ExtraNetworkParams(match.group(2).split(":"))
+        )
+        return ""
+
+    return re_extra_net.sub(found_network, prompt), found
+
+
+def get_multicond_prompt_list(prompts):
+    flat = [part for prompt in prompts for part in prompt.split(" AND ")]
+    return None, flat, None
+
+
+def get_learned_conditioning_prompt_schedules(prompts, steps):
+    return [[[steps, prompt]] for prompt in prompts]
+
+
+def parse_prompt_attention(text):
+    res = []
+    pos = 0
+    for match in re_attention.finditer(text):
+        if match.start() > pos:
+            res.append([text[pos:match.start()], 1.0])
+        res.append([match.group(1), float(match.group(2))])
+        pos = match.end()
+
+    if pos < len(text):
+        res.append([text[pos:], 1.0])
+
+    return res
+
+
+def parse_generation_parameters(text):
+    *lines, last = text.strip().split("\n")
+    res = {"Prompt": lines[0] if lines else ""}
+    for line in lines[1:]:
+        if line.startswith("Negative prompt:"):
+            res["Negative prompt"] = line[len("Negative prompt:"):].strip()
+
+    for key, value in re.findall(r'\s*([\w ]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)', last):
+        res[key] = value.strip('"')
+
+    return res
+
+
+def install_stubs(checkpoints, networks, embedding_dir):
+    callbacks = []
+
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    module("gradio", Info=print, Warning=print, Error=print)
+    module("modules", __path__=[])
+    module(
+        "modules.shared",
+        opts=types.SimpleNamespace(data={"ch_image_metadata": True}),
+        cmd_opts=types.SimpleNamespace()
+    )
+    module("modules.hashes", cache=lambda *args: {}, dump_cache=lambda: None)
+    module("modules.script_callbacks", on_before_image_saved=callbacks.append)
+    module("modules.extra_networks", parse_prompt=parse_prompt)
+    module(
+        "modules.prompt_parser",
+        get_multicond_prompt_list=get_multicond_prompt_list,
+        get_learned_conditioning_prompt_schedules=get_learned_conditioning_prompt_schedules,
+        parse_prompt_attention=parse_prompt_attention,
+    )
+    module("modules.processing", StableDiffusionProcessingTxt2Img=StableDiffusionProcessingTxt2Img)
+    module("modules.sd_models", get_closet_checkpoint_match=checkpoints.get)
+    module("modules.infotext_utils", parse_generation_parameters=parse_generation_parameters)
+    module("modules.processing_scripts", __path__=[])
+    module("modules.processing_scripts.comments", strip_comments=lambda text: text)
+    module("networks", available_network_aliases=networks)
+    module("backend", __path__=[])
+    module("backend.args", dynamic_args={"embedding_dir": embedding_dir})
+
+    for name in ("shared", "hashes", "script_callbacks", "extra_networks", "prompt_parser",
+                 "processing", "sd_models", "infotext_utils"):
+        setattr(sys.modules["modules"], name, sys.modules[f"modules.{name}"])
+    sys.modules["modules.processing_scripts"].comments = sys.modules["modules.processing_scripts.comments"]
+
+    return callbacks
+
+
+def write_model(path, model_type, index):
+    with open(path, "wb") as model_file:
+        model_file.write(b"\0")
+
+    base, _ = os.path.splitext(path)
+    info = {
+        "id": 100000 + index,
+        "name": f"v{index}",
+        "model": {"name": os.path.basename(base), "type": model_type},
+        "description": "x" * 2000,
+        "images": [{"url": f"https://example.com/{index}/{i}.png"} for i in range(20)],
+    }
+    with open(f"{base}.civitai.info", "w") as info_file:
+        json.dump(info, info_file)
+
+
+def build_library(folder, args):
+    checkpoints = {}
+    networks = {}
+
+    for name in ("base", "refiner"):
+        path = os.path.join(folder, f"{name}.safetensors")
+        write_model(path, "Checkpoint", len(checkpoints))
+        checkpoints[name] = CheckpointInfo(name, path)
+
+    lora_dir = os.path.join(folder, "Lora")
+    os.makedirs(lora_dir)
+    for index in range(args.loras):
+        path = os.path.join(lora_dir, f"lora_{index}.safetensors")
+        write_model(path, "LORA", index)
+        networks[f"lora_{index}"] = NetworkOnDisk(path)
+
+    embedding_dir = os.path.join(folder, "embeddings")
+    for index in range(args.embeddings):
+        subfolder = os.path.join(embedding_dir, f"group_{index % 20}")
+        os.makedirs(subfolder, exist_ok=True)
+        write_model(os.path.join(subfolder, f"embed_{index}.safetensors"), "TextualInversion", index)
+
+    return checkpoints, networks, embedding_dir
+
+
+def build_prompts(args):
+    used = min(args.embeddings, 6)
+    loras = " ".join(f"<lora:lora_{index}:0.{index % 9 + 1}>" for index in range(args.loras))
+    embeds = ", ".join(f"(embed_{index}:1.{index})" for index in range(0, used, 2))
+    negative_embeds = ", ".join(f"embed_{index}" for index in range(1, used, 2))
+
+    prompt = f"masterpiece, best quality, 1girl, solo, {embeds}, [city:forest:0.5] AND sunset {loras}"
+    negative = f"lowres, bad anatomy, {negative_embeds}"
+
+    return prompt, negative
+
+
+def make_processing(args, prompt, negative):
+    p = StableDiffusionProcessingTxt2Img()
+    p.sd_model_name = "base"
+    p.prompt = prompt
+    p.negative_prompt = negative
+    p.steps = 30
+    p.extra_network_data = parse_prompt(prompt)[1]
+    p.enable_hr = args.hires
+    p.hr_checkpoint_name = "refiner" if args.hires else None
+    p.hr_checkpoint_info = CheckpointInfo("refiner", "")
+    p.hr_prompt = prompt
+    p.hr_negative_prompt = negative
+    p.hr_second_pass_steps = 15
+    p.hr_extra_network_data = p.extra_network_data
+
+    return p
+
+
+def make_infotext(args, prompt, negative, seed):
+    fields = [
+        "Steps: 30", "Sampler: Euler a", "CFG scale: 7", f"Seed: {seed}",
+        "Size: 832x1216", "Model: base",
+    ]
+    if args.hires:
+        fields += ["Hires upscale: 1.5", "Hires steps: 15", "Hires checkpoint: refiner"]
+
+    for index in range(args.adetailer):
+        suffix = "" if index == 0 else f" {index + 1}nd"
+        fields += [
+            f'ADetailer prompt{suffix}: "detailed face, embed_{index}, <lora:lora_0:0.5>"',
+            f'ADetailer negative prompt{suffix}: "blurry"',
+            f"ADetailer steps{suffix}: 20",
+        ]
+
+    return f"{prompt}\nNegative prompt: {negative}\n{', '.join(fields)}"
+
+
+def reset_caches(image_resources):
+    image_resources.index = None
+    image_resources.records.clear()
+    image_resources.batch["job"] = None
+    image_resources.batch["resources"] = {}
+
+
+def run(hook, image_resources, args, prompt, negative, iterations, measure):
+    p = None
+    samples = []
+    for iteration in range(iterations):
+        if iteration % args.batch_size == 0:
+            p = make_processing(args, prompt, negative)
+        if args.cold:
+            reset_caches(image_resources)
+
+        params = types.SimpleNamespace(
+            p=p,
+            pnginfo={"parameters": make_infotext(args, prompt, negative, iteration)}
+        )
+        samples.append(measure(lambda: hook(params)))
+
+    return samples, params.pnginfo["parameters"]
+
+
+def time_call(call):
+    start = time.perf_counter_ns()
+    call()
+    return time.perf_counter_ns() - start
+
+
+def trace_call(call):
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    return peak - before
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image-save metadata hook.")
+    parser.add_argument("--embeddings", type=int, default=1000, help="embeddings installed")
+    parser.add_argument("--loras", type=int, default=5, help="Loras in the prompt")
+    parser.add_argument("--adetailer", type=int, default=2, help="ADetailer prompt fields in the infotext")
+    parser.add_argument("--hires", action="store_true", help="enable hires. fix with its own checkpoint")
+    parser.add_argument("--batch-size", type=int, default=1, help="images per processing object")
+    parser.add_argument("--cold", action="store_true", help="clear the hook's caches before every image")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        checkpoints, networks, embedding_dir = build_library(folder, args)
+        callbacks = install_stubs(checkpoints, networks, embedding_dir)
+
+        sys.path.insert(0, ROOT)
+        spec = importlib.util.spec_from_file_location(
+            "image_metadata", os.path.join(ROOT, "scripts", "image_metadata.py")
+        )
+        image_metadata = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(image_metadata)
+
+        from ch_lib import image_resources
+
+        hook = callbacks[0]
+        prompt, negative = build_prompts(args)
+
+        run(hook, image_resources, args, prompt, negative, args.warmup, time_call)
+
+        gc.collect()
+        gc.disable()
+        latencies, infotext = run(hook, image_resources, args, prompt, negative, args.iterations, time_call)
+        gc.enable()
+
+        tracemalloc.start()
+        allocations, _ = run(hook, image_resources, args, prompt, negative, args.iterations, trace_call)
+        tracemalloc.stop()
+
+    resources = infotext.rsplit("Civitai resources: ", 1)[-1]
+    print(f"resources per image: {len(json.loads(resources))}")
+    print(
+        f"embeddings={args.embeddings} loras={args.loras} adetailer={args.adetailer} "
+        f"hires={args.hires} batch_size={args.batch_size} cold={args.cold} "
+        f"iterations={args.iterations}"
+    )
+    print(
+        f"latency   p50 {percentile(latencies, 50) / 1e6:8.3f} ms"
+        f"   p99 {percentile(latencies, 99) / 1e6:8.3f} ms"
+        f"   mean {statistics.mean(latencies) / 1e6:8.3f} ms"
+    )
+    print(
+        f"peak mem  p50 {percentile(allocations, 50) / 1024:8.1f} KiB"
+        f"   p99 {percentile(allocations, 99) / 1024:8.1f} KiB"
+    )
+
+
+if __name__ == "__main__":
+    main()
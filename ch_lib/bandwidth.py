@@ -0,0 +1,72 @@
+from __future__ import annotations
+import threading
+import time
+from . import util
+
+
+MODEL = "model"
+IMAGE = "image"
+
+OPTIONS = {
+    MODEL: "ch_dl_model_bandwidth",
+    IMAGE: "ch_dl_image_bandwidth",
+}
+
+MIB = 1024 * 1024
+
+
+class TokenBucket:
+    # Shared by every download of one kind. Tokens are bytes; a rate of 0
+    # means unlimited. Callers reserve bytes up front and sleep off any
+    # debt outside the lock, so concurrent downloads split the budget.
+
+    def __init__(self):
+        self.rate = 0
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate:float) -> None:
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+            self.last = time.monotonic()
+
+    def consume(self, size:int) -> None:
+        with self.lock:
+            if not self.rate:
+                return
+
+            now = time.monotonic()
+            # Allow at most one second of burst.
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+buckets = {kind: TokenBucket() for kind in OPTIONS}
+configured = False
+
+
+def update_limits() -> None:
+    global configured
+
+    for kind, option in OPTIONS.items():
+        limit = util.get_opts(option) or 0
+        buckets[kind].set_rate(float(limit) * MIB)
+
+    configured = True
+
+
+def throttle(kind:str, size:int) -> None:
+    if not configured:
+        update_limits()
+
+    bucket = buckets.get(kind, None)
+    if bucket is not None:
+        bucket.consume(size)
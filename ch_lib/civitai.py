@@ -1,11 +1,20 @@
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from . import util
 from . import model
 from . import downloader
+from . import bandwidth
+from . import thumbnails
+from . import dir_index
+from . import update_cache
+from . import response_cache
 
 SUFFIX = ".civitai"
 
+UPDATE_CHECK_WORKERS = 4
+PREVIEW_CANDIDATES = 3
+
 URLS = {
     "query": "https://civitai.com/api/v1/models?",
     "modelPage": "https://civitai.com/models/",
@@ -58,6 +67,13 @@ NSFW_LEVELS = {
 
 def civitai_get(civitai_url: str):
 
+    if util.is_offline():
+        content = response_cache.get(civitai_url)
+        if content is None:
+            response_cache.queue_miss(civitai_url)
+
+        return content
+
     util.printD(f"Requesting Civitai: {civitai_url}")
 
     success, response = downloader.request_get(
@@ -80,9 +96,40 @@ def civitai_get(civitai_url: str):
         ))
         return None
 
+    response_cache.put(civitai_url, content)
+
     return content
 
 
+def resolve_offline_queue():
+
+    if util.is_offline():
+        yield "Offline mode is enabled. Disable it in settings to resolve queued lookups."
+        return
+
+    queue = response_cache.get_queue()
+    total = len(queue)
+    resolved = 0
+    dropped = 0
+
+    for index, url in enumerate(queue):
+        yield f"Resolving queued lookup {index + 1}/{total}: {url}"
+
+        if civitai_get(url) is not None:
+            resolved += 1
+            response_cache.remove_from_queue(url)
+
+        elif response_cache.record_failure(url):
+            util.printD(f"Dropping queued lookup after {response_cache.MAX_RESOLVE_ATTEMPTS} failed attempts: {url}")
+            dropped += 1
+
+    output = f"Done. Resolved {resolved} of {total} queued lookups."
+    if dropped:
+        output = f"{output} Dropped {dropped} that kept failing."
+    util.printD(output)
+    yield output
+
+
 def append_parent_model_metadata(content):
     util.printD("Fetching Parent Model Information")
     parent_model = get_model_info_by_id(content["modelId"])
@@ -140,6 +187,88 @@ def get_model_info_by_id(model_id: str) -> dict:
     return content
 
 
+def summarize_model_versions(content: dict) -> dict:
+
+    versions = content.get("modelVersions", [])
+    current_version = {}
+    if versions and versions[0]:
+        version = versions[0]
+        current_version = {
+            "id": version.get("id", None),
+            "name": version.get("name", ""),
+            "description": version.get("description", ""),
+            "downloadUrl": version.get("downloadUrl", ""),
+            "images": version.get("images", [])[:1]
+        }
+
+    return {
+        "id": content.get("id", ""),
+        "name": content.get("name", ""),
+        "modelVersions": [current_version] if current_version else []
+    }
+
+
+def get_model_update_info(model_id: str) -> dict:
+
+    util.printD(f"Checking civitai for updates: {model_id}")
+
+    if not model_id:
+        util.printD("model_id is empty")
+        return None
+
+    url = f'{URLS["modelId"]}{model_id}'
+
+    record = update_cache.get(model_id)
+
+    if util.is_offline():
+        if record and record.get("model_info", None):
+            return record["model_info"]
+
+        content = civitai_get(url)
+        if not content:
+            return None
+
+        return summarize_model_versions(content)
+
+    headers = {}
+    if record:
+        if record.get("etag", None):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified", None):
+            headers["If-Modified-Since"] = record["last_modified"]
+
+    success, response = downloader.request_get(url, headers=headers)
+
+    if not success:
+        return None
+
+    with response:
+        if response.status_code == 304 and record:
+            util.printD(f"Model {model_id} has not changed since the last check")
+            update_cache.touch(model_id)
+            return record["model_info"]
+
+        try:
+            content = response.json()
+        except ValueError as e:
+            util.printD(f"Parse response json failed: {str(e)}")
+            return None
+
+        etag = response.headers.get("ETag", None)
+        last_modified = response.headers.get("Last-Modified", None)
+
+    model_info = summarize_model_versions(content)
+
+    update_cache.put(model_id, {
+        "etag": etag,
+        "last_modified": last_modified,
+        "checked": util.ch_time(),
+        "model_info": model_info
+    })
+
+    return model_info
+
+
 def get_version_info_by_version_id(version_id: str) -> dict:
     util.printD("Request version info from civitai")
 
@@ -304,11 +433,7 @@ def preview_exists(model_path):
 
     previews = model.get_potential_model_preview_files(model_path)
 
-    for prev in previews:
-        if os.path.isfile(prev):
-            return True
-
-    return False
+    return dir_index.first_existing(previews) is not None
 
 
 def get_image_url(img_dict, max_size_preview):
@@ -322,39 +447,58 @@ def get_image_url(img_dict, max_size_preview):
     return url
 
 
-def verify_preview(path, img_dict, max_size_preview, nsfw_preview_threshold):
+def is_preview_candidate(img_dict, nsfw_preview_threshold):
 
-    img_url = img_dict.get("url", None)
-    if img_url is None:
-        yield (False, None)
+    if img_dict.get("url", None) is None:
+        return False
 
     image_rating = img_dict.get("nsfwLevel", 32)
     if image_rating > 1:
         util.printD(f"This image is NSFW: {image_rating}")
         if NSFW_LEVELS[nsfw_preview_threshold] < image_rating:
             util.printD("Skip NSFW image")
-            yield (False, None)
+            return False
 
     preview_type = img_dict.get("type")
     if preview_type != "image":
         util.printD(f"Preview is not an image. Found {preview_type} instead. Skipping.")
-        yield (False, None)
+        return False
 
-    img_url = get_image_url(img_dict, max_size_preview)
+    return True
 
-    success = False
-    preview_path = ""
-    for result in downloader.dl_file(img_url, file_path=path):
-        if not isinstance(result, str):
-            success, preview_path = result
-            break
 
-        yield result
+def download_first_preview(path, img_urls):
+    # Fetch a few candidates at once and keep the first one in gallery order
+    # that succeeds. Candidates are held in memory, so losers leave no files.
+    pool = downloader.get_image_pool()
+    pending = list(img_urls)
+    futures = []
 
-    if not success:
-        yield (False, None)
+    while pending or futures:
+        while pending and len(futures) < PREVIEW_CANDIDATES:
+            img_url = pending.pop(0)
+            futures.append((img_url, pool.submit(downloader.fetch_bytes, img_url)))
 
-    yield (True, preview_path)
+        img_url, future = futures.pop(0)
+        success, content = future.result()
+        if not success:
+            util.printD(f"Failed to download preview candidate {img_url}: {content}")
+            continue
+
+        for _, other in futures:
+            other.cancel()
+
+        tmp_path = f"{path}{downloader.DL_EXT}"
+        with open(tmp_path, "wb") as preview_file:
+            preview_file.write(content)
+        os.replace(tmp_path, path)
+        dir_index.add(path)
+        thumbnails.queue(path)
+
+        util.printD(f"Preview downloaded to: {path}")
+        return True
+
+    return False
 
 
 def get_preview_image_by_model_path(model_path: str, max_size_preview, nsfw_preview_threshold, preferred_preview=None):
@@ -396,7 +540,7 @@ def get_preview_image_by_model_path(model_path: str, max_size_preview, nsfw_prev
                 img_url = get_image_url(img_dict, max_size_preview)
                 break
 
-        for result in downloader.dl_file(img_url, file_path=preview_path):
+        for result in downloader.dl_file(img_url, file_path=preview_path, kind=bandwidth.IMAGE):
             if isinstance(result, str):
                 yield result
                 continue
@@ -404,6 +548,7 @@ def get_preview_image_by_model_path(model_path: str, max_size_preview, nsfw_prev
             success, msg = result
 
             if success:
+                thumbnails.queue(preview_path)
                 return
 
             util.printD(msg)
@@ -411,18 +556,17 @@ def get_preview_image_by_model_path(model_path: str, max_size_preview, nsfw_prev
 
             break
 
-    for img_dict in images:
-        for result in verify_preview(
-                preview_path, img_dict, max_size_preview, nsfw_preview_threshold
-        ):
-            if not isinstance(result, str):
-                success, _ = result
-                if success:
-                    return
+    img_urls = [
+        get_image_url(img_dict, max_size_preview)
+        for img_dict in images
+        if is_preview_candidate(img_dict, nsfw_preview_threshold)
+    ]
 
-                break
+    if img_urls:
+        yield "Downloading preview image..."
 
-            yield result
+        if download_first_preview(preview_path, img_urls):
+            return
 
     util.printD(f"Could not find any valid preview images for model: {model_path}")
     yield
@@ -488,24 +632,7 @@ def get_model_id_from_model_path(model_path: str):
     return (model_id, local_version_id)
 
 
-def check_model_new_version_by_path(model_path: str, delay: float = 0.2) -> tuple:
-
-    if not (model_path and os.path.isfile(model_path)):
-        util.printD(f"model_path is not a file: {model_path}")
-        return None
-
-    result = get_model_id_from_model_path(model_path)
-    if not result:
-        return None
-
-    model_id, local_version_id = result
-
-    model_info = get_model_info_by_id(model_id)
-
-    util.delay(delay)
-
-    if not model_info:
-        return None
+def get_new_version_from_model_info(model_path: str, model_info: dict, local_version_id) -> tuple:
 
     model_versions = model_info.get("modelVersions", [])
 
@@ -523,6 +650,7 @@ def check_model_new_version_by_path(model_path: str, delay: float = 0.2) -> tupl
     if not (current_version_id and current_version_id != local_version_id):
         return None
 
+    model_id = model_info.get("id", "")
     model_name = model_info.get("name", "")
     new_version_name = current_version.get("name", "")
     description = current_version.get("description", "")
@@ -539,23 +667,13 @@ def check_model_new_version_by_path(model_path: str, delay: float = 0.2) -> tupl
     )
 
 
-def check_single_model_new_version(root, filename, model_type, delay):
-    item = os.path.join(root, filename)
-    _, ext = os.path.splitext(item)
+def verify_new_version(root, version, model_type):
 
-    if ext not in model.EXTS:
-        return False
-
-    request = check_model_new_version_by_path(item, delay)
-
-    if not request:
-        return False
-
-    request = request + (model_type,)
+    version = version + (model_type,)
 
     model_ids = {
-        'model': request[1],
-        'version': request[3],
+        'model': version[1],
+        'version': version[3],
     }
 
     if not (model_ids['version'] and model_ids['model']):
@@ -566,14 +684,70 @@ def check_single_model_new_version(root, filename, model_type, delay):
         util.printD("New version already exists")
         return False
 
-    return request
+    return version
+
+
+def group_models_by_model_id(model_types: list) -> dict:
+
+    groups = {}
+    for model_type, model_folder in model.folders.items():
+        if model_type not in model_types:
+            continue
+
+        util.printD(f"Scanning path: {model_folder}")
+
+        for root, _, files in os.walk(model_folder, followlinks=True):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                _, ext = os.path.splitext(filepath)
+                if ext not in model.EXTS:
+                    continue
+
+                result = get_model_id_from_model_path(filepath)
+                if not result:
+                    continue
+
+                model_id, local_version_id = result
+                if not model_id:
+                    continue
+
+                groups.setdefault(f"{model_id}", []).append(
+                    (root, filename, model_type, local_version_id)
+                )
+
+    return groups
+
+
+def check_model_group_new_versions(model_id: str, entries: list) -> list:
+
+    model_info = get_model_update_info(model_id)
+
+    if not model_info:
+        return []
+
+    new_versions = []
+    for root, filename, model_type, local_version_id in entries:
+        version = get_new_version_from_model_info(
+            os.path.join(root, filename), model_info, local_version_id
+        )
+
+        if not version:
+            continue
+
+        version = verify_new_version(root, version, model_type)
+        if version:
+            new_versions.append(version)
 
+    update_cache.set_new_versions(model_id, new_versions)
 
-def check_models_new_version_by_model_types(model_types: list, delay: float = 0.2, progress=None) -> list:
+    return new_versions
+
+
+def iter_models_new_version_by_model_types(model_types: list, progress=None):
     util.printD("Checking models' new version")
 
     if not model_types:
-        return []
+        return
 
     mts = []
     if isinstance(model_types, str):
@@ -583,55 +757,43 @@ def check_models_new_version_by_model_types(model_types: list, delay: float = 0.
     else:
         util.printD("Unknown model types:")
         util.printD(model_types)
-        return []
-
-    new_versions = []
-    new_version_ids = []
+        return
 
-    files_to_scan = []
-    for model_type, model_folder in model.folders.items():
-        if model_type not in mts:
-            continue
+    groups = group_models_by_model_id(mts)
 
-        msg = f"Scanning path: {model_folder}"
-        util.printD(msg)
-        
-        for root, _, files in os.walk(model_folder, followlinks=True):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                _, ext = os.path.splitext(filepath)
-                if ext not in model.EXTS:
-                    continue
-                
-                files_to_scan.append((root, filename, model_type))
-
-    total = len(files_to_scan)
+    total = len(groups)
     current = 0
-    
+
     if progress is not None:
         progress((0, total), desc="Starting scan...")
 
-    for root, filename, model_type in files_to_scan:
-        current += 1
-        
-        if progress is not None:
-            progress((current, total), desc=f"Scanning {filename}...")
-            
-        version = check_single_model_new_version(root, filename, model_type, delay)
+    new_version_ids = set()
 
-        if not version:
-            continue
+    pool = ThreadPoolExecutor(max_workers=UPDATE_CHECK_WORKERS)
+    try:
+        futures = [
+            pool.submit(check_model_group_new_versions, model_id, entries)
+            for model_id, entries in groups.items()
+        ]
 
-        version_id = version[3]
+        for future in as_completed(futures):
+            current += 1
 
-        if version_id in new_version_ids:
-            continue
+            if progress is not None:
+                progress((current, total), desc=f"Checked {current} of {total} models...")
 
-        new_versions.append(version)
-        new_version_ids.append(version_id)
-        
+            for version in future.result():
+                version_id = version[3]
 
-    return new_versions
+                if version_id in new_version_ids:
+                    continue
+
+                new_version_ids.add(version_id)
+                yield version
+
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        update_cache.save()
 
 
 def move_model_to_subfolder(filepath, model_info):
@@ -641,6 +803,9 @@ def move_model_to_subfolder(filepath, model_info):
         return None
 
     content = civitai_get(f'{URLS["modelId"]}{model_id}')
+    if not content:
+        util.printD(f"Could not get tags for model {model_id}")
+        return filepath
 
     tags = content["tags"]
 
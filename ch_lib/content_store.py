@@ -0,0 +1,119 @@
+from __future__ import annotations
+import os
+import shutil
+import threading
+from . import util
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+INDEX_FILE = "content_index.json"
+
+# ioctl request to clone a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+index = None
+dirty = False
+lock = threading.Lock()
+
+
+def _load() -> dict:
+    global index
+
+    if index is None:
+        index = util.load_json(util.get_data_path(INDEX_FILE), {})
+
+    return index
+
+
+def save() -> None:
+    global dirty
+
+    with lock:
+        if not dirty:
+            return
+
+        util.write_json(util.get_data_path(INDEX_FILE), _load())
+        dirty = False
+
+
+def _is_unchanged(item:dict) -> bool:
+    # A file edited in place no longer matches the hash it was registered with
+    try:
+        stat = os.stat(item["path"])
+    except OSError:
+        return False
+
+    return stat.st_size == item["size"] and stat.st_mtime_ns == item.get("mtime", None)
+
+
+def register(sha256:str, path:str) -> None:
+    global dirty
+
+    if not (sha256 and path and os.path.isfile(path)):
+        return
+
+    sha256 = sha256.upper()
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    entry = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    with lock:
+        entries = _load().setdefault(sha256, [])
+        entries[:] = [item for item in entries if item["path"] != path]
+        entries.append(entry)
+        dirty = True
+
+
+def lookup(sha256:str) -> str | None:
+    global dirty
+
+    if not sha256:
+        return None
+
+    sha256 = sha256.upper()
+
+    with lock:
+        entries = _load().get(sha256, [])
+        valid = [item for item in entries if _is_unchanged(item)]
+
+        if len(valid) != len(entries):
+            if valid:
+                index[sha256] = valid
+            else:
+                index.pop(sha256, None)
+            dirty = True
+
+    if not valid:
+        return None
+
+    return valid[0]["path"]
+
+
+def reflink(src:str, dst:str) -> None:
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def materialize(src:str, dst:str) -> str:
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+
+    try:
+        reflink(src, dst)
+        return "reflink"
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    shutil.copy2(src, dst)
+    return "copy"
@@ -0,0 +1,100 @@
+from __future__ import annotations
+import os
+import threading
+import time
+
+
+# A listing is only trusted once its directory mtime is this old, since a
+# file added within the filesystem's timestamp granularity of the scan may
+# not change the mtime.
+RACY_WINDOW = 2
+
+# folder: (mtime_ns, trusted, set of file names)
+listings = {}
+lock = threading.Lock()
+
+
+def scan(folder:str) -> set:
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+        with os.scandir(folder) as entries:
+            names = {entry.name for entry in entries if entry.is_file()}
+
+    except OSError:
+        with lock:
+            listings.pop(folder, None)
+        return set()
+
+    trusted = time.time() - mtime / 1e9 > RACY_WINDOW
+
+    with lock:
+        listings[folder] = (mtime, trusted, names)
+
+    return names
+
+
+def list_files(folder:str) -> set:
+    # File names in folder, from one scandir reused until the folder changes.
+    folder = os.path.abspath(folder)
+
+    with lock:
+        listing = listings.get(folder, None)
+
+    if listing is not None:
+        mtime, trusted, names = listing
+        try:
+            current = os.stat(folder).st_mtime_ns
+        except OSError:
+            current = None
+
+        if trusted and current == mtime:
+            return names
+
+    return scan(folder)
+
+
+def exists(path:str) -> bool:
+    folder, name = os.path.split(os.path.abspath(path))
+    return name in list_files(folder)
+
+
+def first_existing(paths:list) -> str | None:
+    for path in paths:
+        if exists(path):
+            return path
+
+    return None
+
+
+def _update(path:str, present:bool) -> None:
+    # Apply our own change to the listing, so it stays valid without a
+    # rescan even though the folder mtime changed.
+    folder, name = os.path.split(os.path.abspath(path))
+
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+    except OSError:
+        return
+
+    with lock:
+        listing = listings.get(folder, None)
+        if listing is None:
+            return
+
+        # Copied, since callers may be iterating the old set.
+        _, trusted, names = listing
+        names = set(names)
+        if present:
+            names.add(name)
+        else:
+            names.discard(name)
+
+        listings[folder] = (mtime, trusted, names)
+
+
+def add(path:str) -> None:
+    _update(path, True)
+
+
+def discard(path:str) -> None:
+    _update(path, False)
@@ -0,0 +1,364 @@
+from __future__ import annotations
+from collections.abc import Callable, Generator
+import threading
+import time
+import traceback
+import uuid
+from . import util
+from . import progress
+from . import resume as resume_state
+
+
+QUEUE_FILE = "dl_queue.json"
+MAX_FINISHED_JOBS = 50
+WATCH_INTERVAL = 0.5
+
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobFailed(Exception):
+    pass
+
+
+runners = {}
+jobs = None
+running = 0
+lock = threading.RLock()
+
+# job id: number of watchers. Pinned jobs are not pruned when finished, so
+# a batch larger than MAX_FINISHED_JOBS is reported in full.
+pins = {}
+
+
+def register_runner(kind:str, runner:Callable[[dict], Generator[str, None, None]]) -> None:
+    runners[kind] = runner
+
+
+def get_concurrency() -> int:
+    concurrency = util.get_opts("ch_dl_concurrency") or 1
+    return max(1, int(concurrency))
+
+
+def _load() -> list:
+    global jobs
+
+    if jobs is None:
+        jobs = util.load_json(util.get_data_path(QUEUE_FILE), [])
+
+        for job in jobs:
+            # Private keys are not persisted
+            job["_memo"] = {}
+
+            # Jobs that were running when webui stopped start over and resume
+            # from their partial download.
+            if job["state"] == RUNNING:
+                job["state"] = QUEUED
+                job["control"] = None
+
+    return jobs
+
+
+def _save() -> None:
+    finished = [
+        job for job in jobs
+        if job["state"] in FINISHED_STATES and job["id"] not in pins
+    ]
+    for job in finished[:-MAX_FINISHED_JOBS]:
+        jobs.remove(job)
+
+    saved = [
+        {key: val for key, val in job.items() if not key.startswith("_")}
+        for job in jobs
+    ]
+    util.write_json(util.get_data_path(QUEUE_FILE), saved)
+
+
+def _find(job_id:str) -> dict | None:
+    for job in _load():
+        if job["id"] == job_id:
+            return job
+
+    return None
+
+
+def _next_job() -> dict | None:
+    queued = [job for job in _load() if job["state"] == QUEUED]
+    if not queued:
+        return None
+
+    return max(queued, key=lambda job: (job["priority"], -job["created"]))
+
+
+def enqueue(kind:str, name:str, args:dict, priority:int=0, memo:dict | None=None) -> str:
+    job = {
+        "id": uuid.uuid4().hex[:8],
+        "kind": kind,
+        "name": name,
+        "args": args,
+        "priority": priority,
+        "state": QUEUED,
+        "control": None,
+        "progress": "Waiting in download queue...",
+        "result": "",
+        "created": util.ch_time(),
+        # Keys starting with "_" are kept in memory only.
+        "_memo": memo or {},
+    }
+
+    with lock:
+        _load().append(job)
+        _save()
+
+    util.printD(f"Queued download job {job['id']}: {name}")
+    dispatch()
+
+    return job["id"]
+
+
+def dispatch() -> None:
+    global running
+
+    with lock:
+        while running < get_concurrency():
+            job = _next_job()
+            if job is None:
+                break
+
+            job["state"] = RUNNING
+            running += 1
+            _save()
+
+            threading.Thread(
+                target=_run, args=(job,), name=f"ch_dl_{job['id']}", daemon=True
+            ).start()
+
+
+def _run(job:dict) -> None:
+    global running
+
+    runner = runners.get(job["kind"], None)
+    state = DONE
+    output = ""
+
+    progress.bind(job["id"])
+
+    try:
+        if runner is None:
+            raise ValueError(f"Unknown download job kind: {job['kind']}")
+
+        steps = runner(job)
+        try:
+            for output in steps:
+                with lock:
+                    job["progress"] = output
+                    control = job["control"]
+
+                if control:
+                    state = control
+                    break
+        finally:
+            steps.close()
+
+    except JobFailed as e:
+        output = str(e)
+        state = FAILED
+
+    except Exception as e:
+        traceback.print_exc()
+        output = f"An error has occurred while downloading: {e}"
+        util.printD(output)
+        state = FAILED
+
+    finally:
+        progress.bind(None)
+        progress.clear(job["id"])
+
+    partials = set(job.get("partials", [])) | progress.pop_partials(job["id"])
+
+    with lock:
+        job["state"] = state
+        job["control"] = None
+        job["finished"] = util.ch_time()
+        # Paused and failed jobs keep their partial files to resume from.
+        job["partials"] = sorted(partials)
+        if state in (DONE, CANCELLED):
+            _discard_partials(job)
+        job["result"] = output if state == DONE or state == FAILED else state.capitalize()
+        if state in FINISHED_STATES:
+            job["_memo"] = {}
+        if not job.pop("_released", False):
+            running -= 1
+        _save()
+
+    dispatch()
+
+
+def release_slot(job:dict) -> None:
+    # Lets the next queued download start while this job finishes work that
+    # does not need a download slot, like fetching metadata and previews.
+    global running
+
+    with lock:
+        if job.get("_released", False):
+            return
+
+        job["_released"] = True
+        running -= 1
+
+    dispatch()
+
+
+def _discard_partials(job:dict) -> None:
+    # A completed download was already renamed, so only leftovers are removed.
+    for dl_path in job.pop("partials", []):
+        try:
+            resume_state.discard(dl_path)
+        except OSError as e:
+            util.printD(f"Could not remove partial download {dl_path}: {e}")
+
+
+def pause(job_id:str) -> bool:
+    return _control(job_id, PAUSED)
+
+
+def cancel(job_id:str) -> bool:
+    return _control(job_id, CANCELLED)
+
+
+def _control(job_id:str, state:str) -> bool:
+    with lock:
+        job = _find(job_id)
+        if job is None or job["state"] in FINISHED_STATES:
+            return False
+
+        if job["state"] == RUNNING:
+            job["control"] = state
+        else:
+            job["state"] = state
+            job["result"] = state.capitalize()
+            if state == CANCELLED:
+                _discard_partials(job)
+            _save()
+
+    return True
+
+
+def resume(job_id:str) -> bool:
+    with lock:
+        job = _find(job_id)
+        if job is None or job["state"] not in (PAUSED, FAILED, CANCELLED):
+            return False
+
+        job["state"] = QUEUED
+        job["progress"] = "Waiting in download queue..."
+        job["result"] = ""
+        _save()
+
+    dispatch()
+    return True
+
+
+def set_priority(job_id:str, priority:int) -> bool:
+    with lock:
+        job = _find(job_id)
+        if job is None:
+            return False
+
+        job["priority"] = int(priority)
+        _save()
+
+    return True
+
+
+def clear_finished() -> None:
+    with lock:
+        for job in [job for job in _load() if job["state"] in FINISHED_STATES]:
+            jobs.remove(job)
+        _save()
+
+
+def get_jobs(job_ids:list | set | None=None) -> list:
+    with lock:
+        jobs_copy = [
+            dict(job) for job in _load()
+            if job_ids is None or job["id"] in job_ids
+        ]
+
+    for job in jobs_copy:
+        job["transfer"] = progress.get(job["id"]) if job["state"] == RUNNING else None
+
+    return jobs_copy
+
+
+def get_job(job_id:str) -> dict | None:
+    with lock:
+        job = _find(job_id)
+        return dict(job) if job else None
+
+
+def pin(job_ids:list | set) -> None:
+    with lock:
+        for job_id in job_ids:
+            pins[job_id] = pins.get(job_id, 0) + 1
+
+
+def unpin(job_ids:list | set) -> None:
+    with lock:
+        for job_id in job_ids:
+            count = pins.get(job_id, 0) - 1
+            if count > 0:
+                pins[job_id] = count
+            else:
+                pins.pop(job_id, None)
+
+
+def watch(job_ids:list) -> Generator[list, None, None]:
+    # Snapshots come at a fixed rate however often the jobs report
+    # progress, so the UI redraws at a steady pace.
+    job_ids = set(job_ids)
+    pin(job_ids)
+    try:
+        while True:
+            started = time.monotonic()
+            snapshot = get_jobs(job_ids)
+            yield snapshot
+
+            if all(job["state"] not in (QUEUED, RUNNING) for job in snapshot):
+                return
+
+            remaining = WATCH_INTERVAL - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    finally:
+        unpin(job_ids)
+
+
+def watch_job(job_id:str) -> Generator[str, None, None]:
+    last = None
+    for snapshot in watch([job_id]):
+        if not snapshot:
+            return
+
+        job = snapshot[0]
+        output = job["result"] or job["progress"]
+        if output != last:
+            last = output
+            yield output
+
+
+def on_app_started(_demo, _app) -> None:
+    with lock:
+        queued = [job for job in _load() if job["state"] == QUEUED]
+
+    if queued:
+        util.printD(f"Resuming {len(queued)} queued downloads")
+
+    dispatch()
@@ -1,54 +1,143 @@
 from __future__ import annotations
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 import os
 import platform
+import threading
 import time
 from typing import cast, Literal
 from tqdm import tqdm
 import requests
 import urllib3
 from . import util
+from . import bandwidth
+from . import dir_index
+from . import progress
+from . import ratelimit
+from . import redirects
+from . import resume
 
 
 DL_EXT = ".downloading"
-MAX_RETRIES = 30
+# Every failed attempt counts toward the host's circuit breaker, so a single
+# request's retries stay below ratelimit.FAILURE_THRESHOLD and a request
+# gives up after MAX_RETRY_TIME seconds of retrying.
+MAX_RETRIES = 4
+MAX_RETRY_TIME = 60
+RETRY_STATUS_CODES = (408, 429)
+
+# Seconds to connect and to wait between bytes, so an unreachable or hung
+# host fails quickly instead of after util.REQUEST_TIMEOUT.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+CHUNK_SIZE = 256 * 1024
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+FLUSH_SIZE = 64 * 1024 * 1024
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+PROGRESS_INTERVAL = 0.2
+RESUME_SAVE_INTERVAL = 2
+WORKER_JOIN_TIMEOUT = 5
+RANGE_UNSUPPORTED = "Server did not honour the range request."
+
+IMAGE_WORKERS = 8
+CONNECTION_POOL_SIZE = 16
 
 urllib3.disable_warnings()
 
-def calculate_stepback_delay_seconds(
-    retries: int
-) -> int:
+session = None
+image_pool = None
+pool_lock = threading.Lock()
 
-    delay = 3 + ((retries >> 1)**2)
-    return delay
+
+def get_session() -> requests.Session:
+    # One session for all requests, so connections to Civitai and its CDN
+    # are reused instead of renegotiated for every file.
+    global session
+
+    with pool_lock:
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=CONNECTION_POOL_SIZE,
+                pool_maxsize=CONNECTION_POOL_SIZE
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+    return session
+
+
+def get_image_pool() -> ThreadPoolExecutor:
+    global image_pool
+
+    with pool_lock:
+        if image_pool is None:
+            image_pool = ThreadPoolExecutor(
+                max_workers=IMAGE_WORKERS,
+                thread_name_prefix="ch_image"
+            )
+
+    return image_pool
 
 
 def request_get(
     url:str,
-    headers:dict | None=None,
-    retries=0
+    headers:dict | None=None
 ) -> tuple[Literal[True], requests.Response] | tuple[Literal[False], str]:
 
+    if util.is_offline():
+        output = f"Offline mode is enabled, not requesting: {url}"
+        util.printD(output)
+        return (False, output)
+
     headers = util.append_default_headers(headers or {})
+    limiter = ratelimit.get_limiter(url)
 
-    try:
-        response = requests.get(
-            url,
-            stream=True,
-            verify=False,
-            headers=headers,
-            proxies=util.PROXIES,
-            timeout=util.REQUEST_TIMEOUT
-        )
+    retries = 0
+    started = time.monotonic()
+    while True:
+        if not limiter.acquire():
+            output = f"Skipping request, {limiter.host} is not responding: {url}"
+            util.printD(output)
+            return (False, output)
 
-    except TimeoutError:
-        output = f"GET Request timed out for {url}"
-        print(output)
-        return (False, output)
+        try:
+            response = get_session().get(
+                url,
+                stream=True,
+                verify=False,
+                headers=headers,
+                proxies=util.PROXIES,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+            )
+
+        except (TimeoutError, requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            limiter.failure()
+            output = f"GET Request timed out for {url}"
+            print(output)
+            return (False, output)
+
+        except requests.exceptions.RequestException as e:
+            # Reported as a failure too, so a half open probe never stays
+            # outstanding.
+            limiter.failure()
+            output = f"GET Request failed for {url}: {e}"
+            print(output)
+            return (False, output)
+
+        if response.ok:
+            limiter.success()
+            return (True, response)
 
-    if not response.ok:
         status_code = response.status_code
         reason = response.reason
+
+        retryable = status_code in RETRY_STATUS_CODES or status_code >= 500
+        if not retryable:
+            # The service answered, it just can't help with this request.
+            limiter.success()
+
         util.printD(util.indented_msg(
             f"""
             GET Request failed with error code:
@@ -65,21 +154,57 @@ def request_get(
         if status_code == 416:
             response.raise_for_status()
 
-        if status_code != 404 and retries < MAX_RETRIES:
-            retry_delay = calculate_stepback_delay_seconds(retries)
-            util.printD(f"Retrying after {retry_delay} seconds")
+        retry_after = None
+        if status_code in (429, 503):
+            retry_after = ratelimit.parse_retry_after(response.headers.get("Retry-After", None))
 
-            time.sleep(retry_delay)
+        response.close()
 
-            return request_get(
-                url,
-                headers,
-                retries + 1
-            )
+        if not retryable:
+            return (False, reason)
+
+        limiter.failure(retry_after)
+
+        if retries >= MAX_RETRIES:
+            return (False, reason)
+
+        retry_delay = limiter.backoff(retries)
+        if time.monotonic() - started + retry_delay > MAX_RETRY_TIME:
+            util.printD(f"Giving up after retrying for {MAX_RETRY_TIME} seconds: {url}")
+            return (False, reason)
+
+        util.printD(f"Retrying after {retry_delay:.1f} seconds")
 
-        return (False, reason)
+        time.sleep(retry_delay)
+        retries += 1
+
+
+def request_download(
+    url:str,
+    headers:dict | None=None
+) -> tuple[Literal[True], requests.Response] | tuple[Literal[False], str]:
+    # Like request_get, but goes straight to where the url last redirected
+    # to while that signed location is still valid.
+    headers = headers or {}
+
+    resolved_url = redirects.get(url)
+    if resolved_url:
+        success, response_or_error = request_get(
+            resolved_url,
+            headers=redirects.headers_for(url, resolved_url, headers)
+        )
+        if success:
+            return (success, response_or_error)
+
+        redirects.invalidate(url)
+
+    success, response_or_error = request_get(url, headers=headers)
+    if success:
+        response = cast(requests.Response, response_or_error)
+        if response.history:
+            redirects.remember(url, response.url)
 
-    return (True, response)
+    return (success, response_or_error)
 
 
 def visualize_progress(percent:int, downloaded:int, total:int, speed:int | float, show_bar=True) -> str:
@@ -104,7 +229,9 @@ def download_progress(
     file_path:str,
     total_size:int,
     headers:dict | None=None,
-    response_without_range:requests.Response | None=None
+    response_without_range:requests.Response | None=None,
+    remote:dict | None=None,
+    kind:str=bandwidth.MODEL
 ) -> Generator[tuple[bool, str] | str, None, None]:
 
     if not headers:
@@ -114,10 +241,19 @@ def download_progress(
 
     util.printD(f"Downloading to temp file: {dl_path}")
 
+    state = resume.new_state(remote, total_size, [[0, total_size - 1, 0]])
+    segment = state["segments"][0]
+
     downloaded_size = 0
     if os.path.exists(dl_path):
         downloaded_size = os.path.getsize(dl_path)
-        util.printD(f"Resuming partially downloaded file from progress: {downloaded_size}")
+        if downloaded_size >= total_size:
+            # Without resume data there is no telling how much of a
+            # preallocated partial file was actually downloaded.
+            util.printD("Partial download has no resume data. Restarting download.")
+            downloaded_size = 0
+        else:
+            util.printD(f"Resuming partially downloaded file from progress: {downloaded_size}")
 
     if response_without_range and downloaded_size == 0:
         response = response_without_range
@@ -130,8 +266,12 @@ def download_progress(
             "Range": f"bytes={downloaded_size:d}-",
         })
 
+        validator = resume.validator(state)
+        if validator:
+            headers_with_range["If-Range"] = validator
+
         try:
-            success, response_or_error = request_get(
+            success, response_or_error = request_download(
                 url,
                 headers=headers_with_range,
             )
@@ -139,14 +279,14 @@ def download_progress(
         except requests.exceptions.HTTPError as dl_error:
 
             if dl_error.response.status_code != 416:
-                util.printD(f"An unhandled error has occurred while requesting data: {dl_error.response.status_cude}.")
+                util.printD(f"An unhandled error has occurred while requesting data: {dl_error.response.status_code}.")
                 raise
 
             util.printD("Could not resume download from existing temporary file. Restarting download.")
 
-            os.remove(dl_path)
+            resume.discard(dl_path)
 
-            yield from download_progress(url, file_path, total_size, headers)
+            yield from download_progress(url, file_path, total_size, headers, remote=remote, kind=kind)
             return
 
         if not success:
@@ -155,49 +295,89 @@ def download_progress(
 
         response = cast(requests.Response, response_or_error)
 
-    last_tick = 0
+        if response.status_code != 206:
+            util.printD("Server ignored the range request or the file has changed. Restarting download.")
+            downloaded_size = 0
+
     start = time.time()
+    last_tick = start
+    last_flush = start
 
     downloaded_this_session = 0
+    unflushed = 0
+
+    segment[2] = downloaded_size
+
+    mode = "r+b" if os.path.exists(dl_path) else "wb"
 
-    with open(dl_path, 'ab') as target, tqdm(
-        initial=target.tell(),
+    with response, open(dl_path, mode, buffering=WRITE_BUFFER_SIZE) as target, tqdm(
+        initial=downloaded_size,
         total=total_size,
         unit='iB',
         unit_scale=True,
         unit_divisor=1024
     ) as progress_bar:
-        for chunk in response.iter_content(chunk_size=256*1024):
-            if chunk:
-                downloaded_this_session += len(chunk)
-                downloaded_size += len(chunk)
-                written = target.write(chunk)
+        preallocate(target, total_size)
+        target.seek(downloaded_size)
+        resume.checkpoint(dl_path, state)
 
-                target.flush()
+        reported = downloaded_size
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if not chunk:
+                continue
 
-                progress_bar.update(written)
+            bandwidth.throttle(kind, len(chunk))
+            target.write(chunk)
+            downloaded_this_session += len(chunk)
+            downloaded_size += len(chunk)
+            unflushed += len(chunk)
 
-                percent = int(100 * (downloaded_size / total_size))
-                timer = time.time()
+            timer = time.time()
 
-                if timer - last_tick > 0.2 or percent == 100:
+            if unflushed >= FLUSH_SIZE or timer - last_flush > RESUME_SAVE_INTERVAL:
+                target.flush()
+                unflushed = 0
+                last_flush = timer
+                segment[2] = downloaded_size
+                resume.checkpoint(dl_path, state)
+
+            if timer - last_tick > PROGRESS_INTERVAL or downloaded_size >= total_size:
+                progress_bar.update(downloaded_size - reported)
+                reported = downloaded_size
+
+                last_tick = timer
+                elapsed = timer - start
+                speed = downloaded_this_session // elapsed if elapsed >= 1 \
+                    else downloaded_this_session
+
+                progress.update(downloaded_size, total_size)
+
+                text_progress = visualize_progress(
+                    int(100 * (downloaded_size / total_size)),
+                    downloaded_size,
+                    total_size,
+                    speed,
+                    False
+                )
 
-                    last_tick = timer
-                    elapsed = timer - start
-                    speed = downloaded_this_session // elapsed if elapsed >= 1 \
-                        else downloaded_this_session
+                yield text_progress
 
-                    text_progress = visualize_progress(
-                        percent,
-                        downloaded_size,
-                        total_size,
-                        speed,
-                        False
-                    )
+        target.flush()
+        segment[2] = downloaded_size
+        resume.checkpoint(dl_path, state)
 
-                    yield text_progress
+    if downloaded_size < total_size:
+        output = util.indented_msg(
+            f"""
+            Download stopped early: {file_path}.
+            Expected {total_size:d} bytes, got {downloaded_size:d}.
+            Download the file again to resume from where it stopped.
+            """
+        )
+        util.printD(output)
+        yield (False, output)
+        return
 
-    downloaded_size = os.path.getsize(dl_path)
     if downloaded_size != total_size:
         warning = util.indented_msg(
             f"""
@@ -210,13 +390,245 @@ def download_progress(
         util.warning(warning)
         util.printD(warning)
 
-    os.rename(dl_path, file_path)
+    os.replace(dl_path, file_path)
+    dir_index.add(file_path)
+    resume.remove(dl_path)
+    output = f"File Downloaded to: {file_path}"
+    util.printD(output)
+
+    yield (True, file_path)
+
+
+def preallocate(target, size:int) -> None:
+    # Reserve the whole file up front so large downloads are not fragmented.
+    target.flush()
+    try:
+        os.posix_fallocate(target.fileno(), 0, size)
+        return
+    except (AttributeError, OSError):
+        pass
+
+    if os.fstat(target.fileno()).st_size < size:
+        target.truncate(size)
+
+
+def get_segment_count(total_size:int) -> int:
+    count = util.get_opts("ch_dl_segments") or 1
+
+    if total_size < SEGMENT_MIN_SIZE:
+        return 1
+
+    return max(1, int(count))
+
+
+def supports_ranges(response:requests.Response) -> bool:
+    return response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+
+def fetch_segment(
+    url:str,
+    dl_path:str,
+    segment:list[int],
+    headers:dict,
+    lock:threading.Lock,
+    stop:threading.Event,
+    errors:list,
+    kind:str=bandwidth.MODEL
+) -> None:
+
+    start, end, done = segment
+    if start + done > end:
+        return
+
+    headers_with_range = {
+        **headers,
+        "Range": f"bytes={start + done:d}-{end:d}",
+    }
+
+    try:
+        success, response_or_error = request_download(url, headers=headers_with_range)
+    except requests.exceptions.HTTPError as dl_error:
+        errors.append(f"Range request failed: {dl_error}")
+        return
+
+    if not success:
+        errors.append(cast(str, response_or_error))
+        return
+
+    response = cast(requests.Response, response_or_error)
+
+    with response:
+        if response.status_code != 206:
+            errors.append(RANGE_UNSUPPORTED)
+            return
+
+        try:
+            with open(dl_path, "r+b", buffering=0) as target:
+                target.seek(start + done)
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if stop.is_set():
+                        return
+
+                    if not chunk:
+                        continue
+
+                    bandwidth.throttle(kind, len(chunk))
+                    target.write(chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+
+        except (OSError, requests.exceptions.RequestException) as e:
+            errors.append(f"Segment {start}-{end} failed: {e}")
+
+
+def download_segmented(
+    url:str,
+    file_path:str,
+    total_size:int,
+    segment_count:int,
+    headers:dict | None=None,
+    remote:dict | None=None,
+    state:dict | None=None,
+    kind:str=bandwidth.MODEL
+) -> Generator[tuple[bool, str] | str, None, None]:
+
+    if not headers:
+        headers = {}
+
+    dl_path = f"{file_path}{DL_EXT}"
+
+    if state and resume.matches(state, remote, total_size):
+        util.printD(f"Resuming segmented download from progress: {resume.downloaded(state)}")
+    else:
+        state = resume.new_state(
+            remote,
+            total_size,
+            resume.plan_segments(total_size, segment_count)
+        )
+
+        with open(dl_path, "wb") as target:
+            preallocate(target, total_size)
+
+        resume.checkpoint(dl_path, state)
+
+    validator = resume.validator(state)
+    if validator:
+        # The server answers with the whole file instead of a range if it
+        # has changed since the download started.
+        headers = {**headers, "If-Range": validator}
+
+    util.printD(f"Downloading to temp file in {len(state['segments'])} segments: {dl_path}")
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+
+    workers = [
+        threading.Thread(
+            target=fetch_segment,
+            args=(url, dl_path, segment, headers, lock, stop, errors, kind),
+            daemon=True
+        )
+        for segment in state["segments"]
+        if segment[0] + segment[2] <= segment[1]
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    start = time.time()
+    initial_size = resume.downloaded(state)
+    last_save = start
+
+    try:
+        with tqdm(
+            initial=initial_size,
+            total=total_size,
+            unit='iB',
+            unit_scale=True,
+            unit_divisor=1024
+        ) as progress_bar:
+            reported = initial_size
+            while any(worker.is_alive() for worker in workers):
+                time.sleep(PROGRESS_INTERVAL)
+
+                with lock:
+                    downloaded_size = resume.downloaded(state)
+
+                progress_bar.update(downloaded_size - reported)
+                reported = downloaded_size
+
+                timer = time.time()
+                if timer - last_save > RESUME_SAVE_INTERVAL:
+                    last_save = timer
+                    with lock:
+                        resume.checkpoint(dl_path, state)
+
+                elapsed = timer - start
+                downloaded_this_session = downloaded_size - initial_size
+                speed = downloaded_this_session // elapsed if elapsed >= 1 \
+                    else downloaded_this_session
+
+                progress.update(downloaded_size, total_size)
+
+                yield visualize_progress(
+                    int(100 * (downloaded_size / total_size)),
+                    downloaded_size,
+                    total_size,
+                    speed,
+                    False
+                )
+
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(WORKER_JOIN_TIMEOUT)
+
+        with lock:
+            resume.checkpoint(dl_path, state)
+
+    if RANGE_UNSUPPORTED in errors:
+        util.printD(util.indented_msg(
+            """
+            Server ignored the range request.
+            It does not support ranges or the file has changed.
+            Restarting download as a single stream.
+            """
+        ))
+        resume.discard(dl_path)
+        headers.pop("If-Range", None)
+        yield from download_progress(url, file_path, total_size, headers, remote=remote, kind=kind)
+        return
+
+    if errors:
+        yield (False, errors[0])
+        return
+
+    downloaded_size = resume.downloaded(state)
+    if downloaded_size != total_size:
+        yield (False, f"Download incomplete: got {downloaded_size:d} of {total_size:d} bytes.")
+        return
+
+    os.replace(dl_path, file_path)
+    dir_index.add(file_path)
+    resume.remove(dl_path)
+
     output = f"File Downloaded to: {file_path}"
     util.printD(output)
 
     yield (True, file_path)
 
 
+def get_remote_info(url:str, response:requests.Response) -> dict:
+    return {
+        "url": url,
+        "resolved_url": response.url,
+        "resolved_expires": redirects.get_expiry(url),
+        "etag": response.headers.get("ETag", None),
+        "last_modified": response.headers.get("Last-Modified", None),
+    }
+
+
 def get_file_path_from_service_headers(response:requests.Response, folder:str) -> str | None:
 
     content_disposition = response.headers.get("Content-Disposition", None)
@@ -240,13 +652,21 @@ def dl_file(
     filename:str | None=None,
     file_path:str | None=None,
     headers:dict | None=None,
-    duplicate:str | None=None
+    duplicate:str | None=None,
+    kind:str=bandwidth.MODEL
 ) -> Generator[tuple[bool, str] | str, None, None]:
 
     if not headers:
         headers = {}
 
-    success, response_or_error = request_get(url, headers=headers)
+    known_path = file_path
+    if not known_path and folder and filename:
+        known_path = os.path.join(folder, filename)
+
+    if known_path:
+        redirects.restore(url, resume.read(f"{known_path}{DL_EXT}"))
+
+    success, response_or_error = request_download(url, headers=headers)
 
     if not success:
         yield (False, cast(str, response_or_error))
@@ -310,7 +730,53 @@ def dl_file(
 
         util.printD(f"File size: {total_size} ({human_readable_filesize(total_size)})")
 
-        yield from download_progress(url, file_path, total_size, headers, response)
+        dl_path = f"{file_path}{DL_EXT}"
+        progress.add_partial(dl_path)
+        segment_count = get_segment_count(total_size)
+        remote = get_remote_info(url, response)
+
+        state = resume.load(dl_path)
+        if state and not resume.matches(state, remote, total_size):
+            util.printD("Remote file has changed since the partial download started. Restarting download.")
+            resume.discard(dl_path)
+            state = None
+
+        if state or (segment_count > 1 and supports_ranges(response)):
+            response.close()
+            yield from download_segmented(
+                url, file_path, total_size, segment_count, headers, remote, state, kind
+            )
+            return
+
+        yield from download_progress(url, file_path, total_size, headers, response, remote, kind)
+
+
+def fetch_file(url:str, file_path:str, headers:dict | None=None) -> tuple[bool, str]:
+    result = (False, "Download did not finish.")
+    for result in dl_file(url, file_path=file_path, headers=headers, kind=bandwidth.IMAGE):
+        if not isinstance(result, str):
+            break
+
+    return result
+
+
+def fetch_bytes(url:str, headers:dict | None=None) -> tuple[Literal[True], bytes] | tuple[Literal[False], str]:
+    success, response_or_error = request_get(url, headers=headers)
+    if not success:
+        return (False, cast(str, response_or_error))
+
+    response = cast(requests.Response, response_or_error)
+    try:
+        with response:
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                bandwidth.throttle(bandwidth.IMAGE, len(chunk))
+                content += chunk
+
+            return (True, bytes(content))
+
+    except requests.exceptions.RequestException as e:
+        return (False, f"Download failed: {e}")
 
 
 def human_readable_filesize(size:int | float) -> str:
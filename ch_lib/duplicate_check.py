@@ -7,6 +7,8 @@ from . import util
 from . import model
 from . import civitai
 from . import templates
+from . import thumbnails
+from . import dir_index
 
 
 def scan_for_dups(scan_model_types, cached_hash, progress=gr.Progress()):
@@ -100,16 +102,6 @@ def parse_metadata(model_folder, root, filename, suffix, model_type, cached_hash
     model_file = model_info["files"][0]
     model_ext = model_file["name"].split(".").pop()
 
-    description = None
-
-    try:
-        description = model_info["model"]["description"]
-    except (ValueError, KeyError):
-        description = model_info.get("description", None)
-
-    if not description:
-        description = ""
-
     model_path = os.path.join(root, f"{model_name}{model_ext}")
 
     if not os.path.isfile(model_path):
@@ -127,7 +119,9 @@ def parse_metadata(model_folder, root, filename, suffix, model_type, cached_hash
     metadata = {
         "model_name": model_name,
         "civitai_name": model_info["model"]["name"],
-        "description": description,
+        # The description is only read for models that turn out to be
+        # duplicates, see load_description
+        "info_path": filepath,
         "model_path": model_path,
         "subpath": model_path[len(model_folder):],
         "model_type": model_type,
@@ -138,6 +132,34 @@ def parse_metadata(model_folder, root, filename, suffix, model_type, cached_hash
     yield metadata
 
 
+def get_description(model_info):
+
+    description = None
+
+    try:
+        description = model_info["model"]["description"]
+    except (ValueError, KeyError):
+        description = model_info.get("description", None)
+
+    if not description:
+        description = ""
+
+    return description
+
+
+def load_description(info_path):
+
+    try:
+        with open(info_path) as file:
+            model_info = json.load(file)
+
+    except (OSError, json.JSONDecodeError):
+        util.printD(f"Could not load description from {info_path}")
+        return ""
+
+    return get_description(model_info)
+
+
 def get_hash(model_path, model_file, model_type, cached_hash):
 
     sha256 = None
@@ -228,15 +250,17 @@ def get_preview(model_path):
 
     prevs = model.get_potential_model_preview_files(model_path, True)
 
-    bg_image = None
-    for prev in prevs:
-        if os.path.isfile(prev):
-            bg_image = prev
-            break
+    bg_image = dir_index.first_existing(prevs)
 
     if not bg_image:
         return ""
 
+    thumb = thumbnails.get_thumbnail(bg_image)
+    if thumb:
+        bg_image = thumb
+    else:
+        thumbnails.queue(bg_image)
+
     return templates.duplicate_preview.substitute(
         bg_image=bg_image
     )
@@ -250,7 +274,7 @@ def make_model_card(model_data):
     style = "font-size:100%"
     model_name = model_data["model_name"]
     subpath = model_data["subpath"].replace("'", "\\'")
-    description = html.escape(model_data["description"])
+    description = html.escape(load_description(model_data["info_path"]))
     search_term = model_data["search_term"].replace("'", "\\'")
     model_type = model_data["model_type"]
 
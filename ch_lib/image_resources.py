@@ -0,0 +1,230 @@
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from . import util
+
+
+EMBEDDING_EXTS = (".BIN", ".PT", ".SAFETENSORS")
+
+# How often the embedding index checks its directories for changes. Within
+# the interval lookups don't touch the filesystem at all.
+INDEX_CHECK_INTERVAL = 5
+
+# Embedding names must stand alone: surrounded by whitespace, commas, periods
+# or the ends of the prompt.
+SEPARATORS = ",."
+MATCH_CACHE_SIZE = 4096
+
+
+class EmbeddingMatcher:
+    # Trie of embedding names, walked from every token start in a prompt.
+    # The cost depends on the prompt and the longest name, not on how many
+    # embeddings are installed.
+
+    END = ""
+
+    def __init__(self, names):
+        self.root = {}
+        for name in names:
+            node = self.root
+            for char in name:
+                node = node.setdefault(char, {})
+            node[self.END] = name
+
+        self.cache = {}
+
+    @staticmethod
+    def is_separator(char:str) -> bool:
+        return char.isspace() or char in SEPARATORS
+
+    def findall(self, text:str) -> list[str]:
+        found = self.cache.get(text, None)
+        if found is not None:
+            return found
+
+        found = []
+        lowered = text.lower()
+        length = len(lowered)
+        start = 0
+
+        while start < length:
+            if start and not self.is_separator(lowered[start - 1]):
+                start += 1
+                continue
+
+            # Take the longest name that ends on a separator.
+            node = self.root
+            match = None
+            end = start
+            while end < length:
+                node = node.get(lowered[end], None)
+                if node is None:
+                    break
+                end += 1
+                if self.END in node and (end == length or self.is_separator(lowered[end])):
+                    match = (node[self.END], end)
+
+            if match is None:
+                start += 1
+                continue
+
+            found.append(match[0])
+            start = match[1]
+
+        if len(self.cache) >= MATCH_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[text] = found
+
+        return found
+
+
+index = None
+checked = 0
+lock = threading.Lock()
+
+# .civitai.info path: (mtime, record)
+records = {}
+records_lock = threading.Lock()
+
+# Resource lists of the processing job whose images are being saved
+BATCH_MEMO_SIZE = 16
+batch = {"job": None, "resources": {}}
+batch_lock = threading.Lock()
+
+
+def build_embedding_index(root:str) -> dict:
+    paths = {}
+    # Directory mtimes change when files are added, removed or renamed.
+    dirs = {}
+    # Files that are still being written are skipped until they have data.
+    empty = []
+
+    try:
+        for dirpath, _, filenames in os.walk(root, followlinks=True):
+            dirs[dirpath] = os.stat(dirpath).st_mtime_ns
+
+            for filename in filenames:
+                filepath = Path(dirpath) / filename
+                if filepath.suffix.upper() not in EMBEDDING_EXTS:
+                    continue
+
+                if filepath.stat().st_size == 0:
+                    empty.append(str(filepath))
+                    continue
+
+                paths[filepath.stem.strip().lower()] = filepath.absolute()
+
+    except Exception as e:
+        util.printD(f"Embedding directory error: {e}")
+
+    return {
+        "root": root,
+        "paths": paths,
+        "matcher": EmbeddingMatcher(paths.keys()),
+        "dirs": dirs,
+        "empty": empty,
+    }
+
+
+def embedding_index_changed() -> bool:
+    try:
+        for dirpath, mtime in index["dirs"].items():
+            if os.stat(dirpath).st_mtime_ns != mtime:
+                return True
+
+        for filepath in index["empty"]:
+            if os.path.getsize(filepath) != 0:
+                return True
+
+    except OSError:
+        return True
+
+    return False
+
+
+def get_embedding_index(root:str) -> dict:
+    global index, checked
+
+    with lock:
+        now = time.monotonic()
+
+        if index is None or index["root"] != root:
+            index = build_embedding_index(root)
+            checked = now
+
+        elif now - checked > INDEX_CHECK_INTERVAL:
+            checked = now
+            if embedding_index_changed():
+                util.printD("Embedding directory changed, rebuilding the embedding index.")
+                index = build_embedding_index(root)
+
+        return index
+
+
+def get_resource_record(base_file_path) -> dict:
+    # Only the few fields written to image metadata are kept, and they are
+    # serialized once. Raises FileNotFoundError if the model was never scanned.
+    file_path = Path(base_file_path).with_suffix(".civitai.info")
+    mtime = os.stat(file_path).st_mtime_ns
+    key = str(file_path)
+
+    with records_lock:
+        cached = records.get(key, None)
+
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(file_path, 'r') as file:
+        civitai_info = json.load(file)
+
+    fields = {
+        "modelVersionId": civitai_info["id"],
+        "modelName": civitai_info["model"]["name"],
+        "modelVersionName": civitai_info["name"],
+    }
+    record = {
+        "type": civitai_info["model"]["type"].lower(),
+        "fields": json.dumps(fields, separators=(',', ':'))[1:-1],
+    }
+
+    with records_lock:
+        records[key] = (mtime, record)
+
+    return record
+
+
+def format_resource(record:dict, weight=None, type_name=None) -> str:
+    # Same output as json.dumps of the resource dict with compact separators.
+    resource_type = type_name if type_name is not None else record["type"]
+    if resource_type in ["locon", "loha"]:
+        resource_type = "lycoris"
+
+    parts = [f'"type":{json.dumps(resource_type)}']
+    if weight is not None:
+        parts.append(f'"weight":{json.dumps(weight)}')
+    parts.append(record["fields"])
+
+    return "{" + ",".join(parts) + "}"
+
+
+def get_batch_resources(job_id:int, key:tuple) -> list | None:
+    with batch_lock:
+        if batch["job"] != job_id:
+            return None
+
+        return batch["resources"].get(key, None)
+
+
+def set_batch_resources(job_id:int, key:tuple, resources:list) -> None:
+    with batch_lock:
+        if batch["job"] != job_id:
+            batch["job"] = job_id
+            batch["resources"] = {}
+
+        if len(batch["resources"]) >= BATCH_MEMO_SIZE:
+            batch["resources"].clear()
+
+        batch["resources"][key] = resources
@@ -0,0 +1,180 @@
+from __future__ import annotations
+import hashlib
+import os
+import threading
+from . import util
+from . import content_store
+from . import dir_index
+
+
+INDEX_FILE = "example_images.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# {"urls": {url: sha256}, "files": {sha256: [{"path": str, "size": int, "mtime": int}]}}
+index = None
+lock = threading.Lock()
+
+
+def _load() -> dict:
+    global index
+
+    if index is None:
+        index = util.load_json(util.get_data_path(INDEX_FILE), {})
+        index.setdefault("urls", {})
+        index.setdefault("files", {})
+
+    return index
+
+
+def save() -> None:
+    with lock:
+        util.write_json(util.get_data_path(INDEX_FILE), _load())
+
+
+def is_enabled() -> bool:
+    return bool(util.get_opts("ch_shared_example_images"))
+
+
+def hash_file(path:str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest().upper()
+
+
+def _is_unchanged(item:dict) -> bool:
+    # A file edited or replaced in place no longer matches its hash
+    try:
+        stat = os.stat(item["path"])
+    except OSError:
+        return False
+
+    return stat.st_size == item["size"] and stat.st_mtime_ns == item.get("mtime", None)
+
+
+def _valid_files(sha256:str) -> list:
+    # Must hold lock. Entries whose file was removed or changed are dropped.
+    files = _load()["files"]
+    entries = files.get(sha256, [])
+    valid = [item for item in entries if _is_unchanged(item)]
+
+    if len(valid) != len(entries):
+        if valid:
+            files[sha256] = valid
+        else:
+            files.pop(sha256, None)
+
+    return valid
+
+
+def find_url(url:str) -> str | None:
+    # Local copy of an image that was downloaded from url for another model.
+    with lock:
+        sha256 = _load()["urls"].get(url, None)
+        if sha256 is None:
+            return None
+
+        valid = _valid_files(sha256)
+
+    if not valid:
+        return None
+
+    return valid[0]["path"]
+
+
+def register(path:str, sha256:str, url:str | None=None) -> str | None:
+    # Records path under sha256 and returns an existing file with the same
+    # content, if there is one that path isn't already linked to.
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    entry = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    with lock:
+        data = _load()
+        if url:
+            data["urls"][url] = sha256
+
+        valid = _valid_files(sha256)
+        source = None
+        for item in valid:
+            if item["path"] != path and not os.path.samefile(item["path"], path):
+                source = item["path"]
+                break
+
+        if not any(item["path"] == path for item in valid):
+            valid.append(entry)
+        data["files"][sha256] = valid
+
+    return source
+
+
+def link(src:str, dst:str) -> None:
+    # Replaces dst with a link to src. Copies are not made, since they would
+    # not save any space.
+    tmp_path = f"{dst}.tmp"
+
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            content_store.reflink(src, tmp_path)
+
+        os.replace(tmp_path, dst)
+
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def reuse(url:str, dst:str) -> bool:
+    # Materializes dst from an earlier download of url instead of fetching it.
+    src = find_url(url)
+    if not src:
+        return False
+
+    try:
+        method = content_store.materialize(src, dst)
+    except OSError as e:
+        util.printD(f"Could not reuse example image {src}: {e}")
+        return False
+
+    dir_index.add(dst)
+    util.printD(f"Reused example image ({method}): {src}")
+
+    with lock:
+        sha256 = _load()["urls"][url]
+
+    try:
+        register(dst, sha256)
+    except OSError as e:
+        util.printD(f"Could not add {dst} to the example image store: {e}")
+
+    return True
+
+
+def add(path:str, url:str | None=None) -> int:
+    # Stores a downloaded or existing example image, linking it to an
+    # identical file already in the store. Returns the bytes freed.
+    try:
+        sha256 = hash_file(path)
+        source = register(path, sha256, url)
+    except OSError as e:
+        util.printD(f"Could not add {path} to the example image store: {e}")
+        return 0
+
+    if source is None:
+        return 0
+
+    size = os.path.getsize(path)
+    try:
+        link(source, path)
+        # The link has the stored file's mtime, so the entry is recorded again
+        register(path, sha256)
+    except OSError as e:
+        util.printD(f"Could not link {path} to {source}: {e}")
+        return 0
+
+    return size
@@ -4,8 +4,12 @@ import webbrowser
 from . import util
 from . import model
 from . import civitai
+from . import content_store
 from . import msg_handler
 from . import downloader
+from . import dl_queue
+from . import dir_index
+from . import update_cache
 
 
 def open_model_url(msg):
@@ -118,6 +122,12 @@ def use_preview_image_prompt(msg):
         util.printD(f"No images from info file for {model_type} {search_term}")
         return [prompt, neg_prompt, prompt, neg_prompt]
 
+    # Lazy mode fetches a model's example images once it is looked at
+    if util.get_opts("ch_download_examples") and util.get_opts("ch_lazy_examples"):
+        model_path = model.get_model_path_by_search_term(model_type, search_term)
+        if model_path:
+            model.queue_example_images(model_path, on_demand=True)
+
     preview_prompt = ""
     preview_neg_prompt = ""
     for img in images:
@@ -140,11 +150,6 @@ def use_preview_image_prompt(msg):
 def dl_model_new_version(msg):
     util.printD("Start dl_model_new_version")
 
-    output = ""
-
-    max_size_preview = util.get_opts("ch_max_size_preview")
-    nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
-
     result = msg_handler.parse_js_msg(msg)
     if not result:
         output = "Parsing js msg failed"
@@ -168,6 +173,30 @@ def dl_model_new_version(msg):
         yield output
         return
 
+    args = {
+        "model_path": model_path,
+        "version_id": version_id,
+        "download_url": download_url,
+        "model_type": model_type,
+    }
+
+    job_id = dl_queue.enqueue(
+        "new_version",
+        f"{os.path.basename(model_path)} (new version {version_id})",
+        args,
+        priority=1
+    )
+
+    yield from dl_queue.watch_job(job_id)
+
+
+def download_model_new_version(model_path, version_id, download_url, model_type):
+
+    output = ""
+
+    max_size_preview = util.get_opts("ch_max_size_preview")
+    nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
+
     util.printD(f"model_path: {model_path}")
     util.printD(f"version_id: {version_id}")
     util.printD(f"download_url: {download_url}")
@@ -175,8 +204,7 @@ def dl_model_new_version(msg):
     if not os.path.isfile(model_path):
         output = f"model_path is not a file: {model_path}"
         util.printD(output)
-        yield output
-        return
+        raise dl_queue.JobFailed(output)
 
     model_folder = os.path.dirname(model_path)
 
@@ -196,13 +224,18 @@ def dl_model_new_version(msg):
 
     if not success:
         util.printD(output)
-        yield "Model download failed. See console for more details."
-        return
+        raise dl_queue.JobFailed("Model download failed. See console for more details.")
 
     version_info = civitai.get_version_info_by_version_id(version_id)
 
     model.process_model_info(output, version_info, model_type)
 
+    content_store.register(get_file_sha256(version_info, download_url, output), output)
+    content_store.save()
+
+    update_cache.remove_new_version(version_id)
+    update_cache.save()
+
     for result in civitai.get_preview_image_by_model_path(
         output,
         max_size_preview,
@@ -215,6 +248,22 @@ def dl_model_new_version(msg):
     yield output
 
 
+def get_file_sha256(version_info, download_url, file_path):
+    name = os.path.basename(file_path)
+    for file_info in (version_info or {}).get("files", []):
+        if file_info.get("downloadUrl", None) == download_url or file_info.get("name", None) == name:
+            return file_info.get("hashes", {}).get("SHA256", None)
+
+    return None
+
+
+def run_new_version_job(job):
+    yield from download_model_new_version(**job["args"])
+
+
+dl_queue.register_runner("new_version", run_new_version_job)
+
+
 def get_model_path_from_js_msg(result):
     if not result:
         output = "Parsing js ms failed"
@@ -287,6 +336,8 @@ def rename_model_by_path(msg):
         renamed.append(f"* {candidate_file} to {new_path}")
         util.printD(f"Renaming file {candidate_file} to {new_path}")
         os.rename(candidate_file, new_path)
+        dir_index.discard(candidate_file)
+        dir_index.add(new_path)
 
     renamed = "\n".join(renamed)
     status = f"The following files were renamed: \n{renamed}"
@@ -315,6 +366,7 @@ def remove_model_by_path(msg):
         util.printD(f"* Removing file {candidate_file}")
         removed.append(candidate_file)
         os.remove(candidate_file)
+        dir_index.discard(candidate_file)
 
     removed = "\n".join(removed)
     status = f"The following files were removed: \n{removed}"
@@ -1,7 +1,9 @@
-import glob
+from collections import deque
+from concurrent.futures import as_completed
 import os
 import json
 import re
+import threading
 import urllib.parse
 from PIL import Image
 import piexif
@@ -10,6 +12,9 @@ from modules import shared
 from modules import paths_internal
 from . import civitai
 from . import downloader
+from . import dir_index
+from . import image_store
+from . import thumbnails
 from . import util
 
 
@@ -20,6 +25,13 @@ EXTS = (".bin", ".pt", ".safetensors", ".ckpt", ".gguf", ".zip")
 CIVITAI_EXT = ".info"
 SDWEBUI_EXT = ".json"
 
+# Models waiting for background prefetch of their example images in lazy mode.
+# Further models are dropped until the queue drains; they are fetched on demand.
+PREFETCH_QUEUE_SIZE = 64
+
+examples = {"demand": deque(), "prefetch": deque(), "queued": set(), "worker": None}
+examples_lock = threading.Lock()
+
 folders = {
     "ti": os.path.join(ROOT_PATH, "embeddings"),
     "hyper": os.path.join(MODELS_PATH, "hypernetworks"),
@@ -63,12 +75,174 @@ def local_image(model_info, img):
     return None
 
 
-def next_example_image_path(model_path):
-    base_path, _ = os.path.splitext(model_path)
-    i = 0
-    while glob.glob(f"{base_path}.example.{i}.*"):
+def get_example_indexes(model_path):
+    folder, filename = os.path.split(model_path)
+    prefix = f"{os.path.splitext(filename)[0]}.example."
+
+    used = set()
+    for name in dir_index.list_files(folder):
+        if name.startswith(prefix):
+            index = name[len(prefix):].split(".", 1)[0]
+            if index.isdigit():
+                used.add(int(index))
+
+    return used
+
+
+def next_example_index(model_path, start=0, used=None):
+    if used is None:
+        used = get_example_indexes(model_path)
+
+    i = start
+    while i in used:
         i += 1
-    return f"{base_path}.example.{i}"
+    return i
+
+
+def fetch_example_image(url, outpath):
+    # Images shared with other models are linked from the store instead of
+    # downloaded again.
+    shared_store = image_store.is_enabled()
+    if shared_store and image_store.reuse(url, outpath):
+        return (True, outpath)
+
+    success, result = downloader.fetch_file(url, outpath)
+    if success and shared_store:
+        image_store.add(outpath, url)
+
+    return (success, result)
+
+
+def download_example_images(model_path, images):
+    # Paths are picked up front so the downloads can run side by side.
+    base_path, _ = os.path.splitext(model_path)
+    used = get_example_indexes(model_path)
+    index = 0
+    futures = {}
+
+    for img in images:
+        url = img["url"]
+        _, ext = os.path.splitext(urllib.parse.urlparse(url).path)
+        index = next_example_index(model_path, index, used)
+        outpath = f"{base_path}.example.{index}{ext}"
+        index += 1
+
+        future = downloader.get_image_pool().submit(fetch_example_image, url, outpath)
+        futures[future] = (img, url, outpath)
+
+    downloaded = 0
+    for future in as_completed(futures):
+        img, url, outpath = futures[future]
+        try:
+            success, _ = future.result()
+        except Exception as e:
+            util.printD(f"Error downloading {url}: {e}")
+            success = False
+
+        if not success:
+            downloader.error(url, "Failed to download model image.")
+            continue
+
+        img["local_file"] = outpath
+        thumbnails.queue(outpath)
+        downloaded += 1
+
+    if downloaded and image_store.is_enabled():
+        image_store.save()
+
+    return downloaded
+
+
+def get_wanted_example_images(model_info):
+    # Example images with a URL that pass the NSFW threshold, in gallery order
+    nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
+    wanted = []
+
+    for img in model_info.get("images", []):
+        rating = img.get("nsfwLevel", 32)
+        if rating > 1:
+            if civitai.NSFW_LEVELS[nsfw_preview_threshold] < rating:
+                continue
+
+        if img.get("url", None):
+            wanted.append(img)
+
+    return wanted
+
+
+def materialize_example_images(model_path, limit=None):
+    # Downloads example images that a lazy scan only recorded in the info
+    # file. limit caps how many of the first images are fetched.
+    info_file, _ = get_model_info_paths(model_path)
+    try:
+        model_info = load_model_info(info_file)
+    except OSError as e:
+        util.printD(f"Could not load model info {info_file}: {e}")
+        return 0
+
+    if not model_info:
+        return 0
+
+    wanted = get_wanted_example_images(model_info)
+    if limit is not None:
+        wanted = wanted[:limit]
+
+    missing = [img for img in wanted if not img.get("local_file", None)]
+    if not missing:
+        return 0
+
+    downloaded = download_example_images(model_path, missing)
+    if downloaded:
+        write_info(model_info, info_file, "civitai")
+
+    return downloaded
+
+
+def run_example_queue():
+    while True:
+        with examples_lock:
+            if examples["demand"]:
+                model_path = examples["demand"].popleft()
+                limit = None
+            elif examples["prefetch"]:
+                model_path = examples["prefetch"].popleft()
+                examples["queued"].discard(model_path)
+                limit = util.get_opts("ch_example_prefetch") or 0
+            else:
+                examples["worker"] = None
+                return
+
+        if limit is not None and limit <= 0:
+            continue
+
+        try:
+            materialize_example_images(model_path, limit)
+        except Exception as e:
+            util.printD(f"Error downloading example images for {model_path}: {e}")
+
+
+def queue_example_images(model_path, on_demand=False):
+    # On demand requests come from the user looking at a model and are
+    # served before prefetches.
+    with examples_lock:
+        if on_demand:
+            if model_path in examples["demand"]:
+                return
+            examples["demand"].append(model_path)
+
+        else:
+            if model_path in examples["queued"] or len(examples["prefetch"]) >= PREFETCH_QUEUE_SIZE:
+                return
+            examples["queued"].add(model_path)
+            examples["prefetch"].append(model_path)
+
+        if examples["worker"] is None:
+            examples["worker"] = threading.Thread(
+                target=run_example_queue,
+                name="ch_examples",
+                daemon=True
+            )
+            examples["worker"].start()
 
 
 def get_custom_model_folder():
@@ -200,43 +374,23 @@ def process_model_info(model_path, model_info, model_type="ckp", refetch_old=Fal
 
 
     updated = False
+    lazy = False
     if util.get_opts("ch_download_examples"):
-        images = model_info.get("images", [])
-
-        for img in images:
-            url = img.get("url", None)
+        missing = []
 
+        for img in get_wanted_example_images(model_info):
+            existing_dl = local_image(existing_info, img)
+            if existing_dl:
+                img["local_file"] = existing_dl
 
-            nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
-            rating = img.get("nsfwLevel", 32)
-            if rating > 1:
-                if civitai.NSFW_LEVELS[nsfw_preview_threshold] < rating:
-                    continue
+            else:
+                missing.append(img)
 
-            if url:
-                existing_dl = local_image(existing_info, img)
-                if existing_dl:
-                    img["local_file"] = existing_dl
-
-                else:
-                    path = urllib.parse.urlparse(url).path
-                    _, ext = os.path.splitext(path)
-                    outpath = next_example_image_path(model_path) + ext
-
-                    for result in downloader.dl_file(
-                            url,
-                            folder=os.path.dirname(outpath),
-                            filename=os.path.basename(outpath)):
-                        if not isinstance(result, str):
-                            success, output = result
-                            break
-
-                    if not success:
-                        downloader.error(url, "Failed to download model image.")
-                        continue
-
-                    img["local_file"] = outpath
-                    updated = True
+        # In lazy mode the URLs are only recorded, and the images are
+        # fetched in the background once the info file is written.
+        lazy = bool(missing) and util.get_opts("ch_lazy_examples")
+        if missing and not lazy:
+            updated = download_example_images(model_path, missing) > 0
 
     if metadata_needed_for_type(info_file, "civitai", refetch_old) or updated:
         if refetch_old:
@@ -251,6 +405,9 @@ def process_model_info(model_path, model_info, model_type="ckp", refetch_old=Fal
         else:
             write_info(model_info, info_file, "civitai")
 
+    if lazy:
+        queue_example_images(model_path)
+
     if not util.get_opts("ch_dl_webui_metadata"):
         return
 
@@ -348,8 +505,10 @@ def get_model_files_from_model_path(model_path):
     preview_paths = get_potential_model_preview_files(model_path)
 
     paths = paths + preview_paths
+    paths += [thumbnails.get_thumbnail_path(path) for path in [user_preview_path] + preview_paths]
 
-    return [path for path in paths if os.path.isfile(path)]
+    # Previews of every extension share one thumbnail path
+    return [path for path in dict.fromkeys(paths) if dir_index.exists(path)]
 
 
 def get_model_names_by_type(model_type:str) -> list:
@@ -1,13 +1,25 @@
 import os
-import time
 import re
+import time
 import gradio as gr
 from modules import sd_models
 from . import util
 from . import model
 from . import civitai
+from . import content_store
+from . import image_store
 from . import downloader
+from . import ratelimit
+from . import dl_queue
 from . import templates
+from . import update_cache
+
+
+# Seconds between refreshes of the new version cards while checking
+UPDATE_RENDER_INTERVAL = 1
+
+# model.example.N.ext, but not its thumbnail
+EXAMPLE_IMAGE_RE = re.compile(r"\.example\.\d+\.[^.]+$")
 
 
 def get_metadata_skeleton():
@@ -43,7 +55,7 @@ def get_metadata_skeleton():
     return metadata
 
 
-def scan_single_model(filepath, model_type, refetch_old, organize_models, delay):
+def scan_single_model(filepath, model_type, refetch_old, organize_models):
 
     filename = os.path.basename(filepath)
 
@@ -71,9 +83,11 @@ def scan_single_model(filepath, model_type, refetch_old, organize_models, delay)
             output = f"failed generating SHA256 for model: {filename}"
             util.printD(output)
             yield output
-            time.sleep(delay)
             yield False
 
+        if not use_auto_v3:
+            content_store.register(sha256_hash, filepath)
+
         civitai_hash = sha256_hash
         if use_auto_v3:
             civitai_hash = sha256_hash[:12]
@@ -81,6 +95,20 @@ def scan_single_model(filepath, model_type, refetch_old, organize_models, delay)
         yield "Requesting model information from Civitai"
         model_info = civitai.get_model_info_by_hash(civitai_hash)
 
+        if not model_info and util.is_offline():
+            output = f"No cached model info in offline mode, skipping: {filename}"
+            util.printD(output)
+            yield output
+            yield False
+            return
+
+        if not model_info and ratelimit.circuit_open(civitai.URLS["hash"]):
+            output = f"Civitai is not responding, skipping: {filename}"
+            util.printD(output)
+            yield output
+            yield False
+            return
+
         if not model_info:
             model_info = dummy_model_info(filepath, civitai_hash, model_type)
             yield True
@@ -90,8 +118,6 @@ def scan_single_model(filepath, model_type, refetch_old, organize_models, delay)
 
         model.process_model_info(filepath, model_info, model_type, refetch_old=refetch_old)
 
-        time.sleep(delay)
-
     else:
         util.printD(f"Model metadata not needed for {filename}")
 
@@ -100,8 +126,6 @@ def scan_single_model(filepath, model_type, refetch_old, organize_models, delay)
 
 def scan_model(scan_model_types, refetch_old, organize_models=False, progress=gr.Progress()):
 
-    delay = 0.2
-
     util.printD("Start scan_model")
     output = ""
 
@@ -150,7 +174,7 @@ def scan_model(scan_model_types, refetch_old, organize_models=False, progress=gr
 
         count[0] = count[0] + 1
 
-        for result in scan_single_model(filepath, model_type, refetch_old, organize_models, delay):
+        for result in scan_single_model(filepath, model_type, refetch_old, organize_models):
             if isinstance(result, str):
                 progress(tracker, desc=result, unit="models")
                 continue
@@ -175,6 +199,8 @@ def scan_model(scan_model_types, refetch_old, organize_models=False, progress=gr
         ):
             pass
 
+    content_store.save()
+
     output = f"Done. Successfully scanned {count[1]} of {len(models)} models."
 
     util.printD(output)
@@ -182,6 +208,70 @@ def scan_model(scan_model_types, refetch_old, organize_models=False, progress=gr
     yield output
 
 
+def dedupe_example_images(scan_model_types, progress=gr.Progress()):
+    # Adds existing example images to the shared store, replacing identical
+    # copies with links to one file.
+
+    util.printD("Start dedupe_example_images")
+
+    if not scan_model_types:
+        output = "Model Types is None, can not reconcile."
+        util.printD(output)
+        return output
+
+    model_types = scan_model_types
+    if isinstance(scan_model_types, str):
+        model_types = [scan_model_types]
+
+    examples = []
+    urls = {}
+    for model_type, model_folder in model.folders.items():
+        if model_type not in model_types:
+            continue
+
+        util.printD(f"Reconciling example images in: {model_folder}")
+        for root, _, files in os.walk(model_folder, followlinks=True):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+
+                if EXAMPLE_IMAGE_RE.search(filename):
+                    examples.append(filepath)
+
+                elif filename.endswith(".civitai.info"):
+                    # Remember where each gallery URL was saved, so later
+                    # downloads of the same URL are linked from the store.
+                    try:
+                        model_info = model.load_model_info(filepath)
+                    except OSError:
+                        continue
+
+                    for img in (model_info or {}).get("images", []):
+                        local_file = img.get("local_file", None)
+                        if img.get("url", None) and local_file:
+                            urls[os.path.realpath(local_file)] = img["url"]
+
+    linked = 0
+    freed = 0
+    total = len(examples)
+    for i, filepath in enumerate(examples):
+        progress((i, total), desc="Reconciling...", unit="images")
+
+        size = image_store.add(filepath, urls.get(os.path.realpath(filepath), None))
+        if size:
+            linked += 1
+            freed += size
+
+    image_store.save()
+
+    output = (
+        f"Done. Checked {total} example images, linked {linked} duplicates "
+        f"and freed {downloader.human_readable_filesize(freed)}B."
+    )
+    util.printD(output)
+
+    return output
+
+
 def dummy_model_info(path, sha256_hash, model_type):
     if not sha256_hash:
         return {}
@@ -312,29 +402,45 @@ def build_article_from_version(version):
 
 def check_models_new_version_to_md(model_types:list, progress=gr.Progress()) -> str:
     yield "Searching for new versions..."
-    new_versions = civitai.check_models_new_version_by_model_types(model_types, 0.2, progress)
-
-    if not new_versions:
-        util.printD("Done: no new versions found.")
-        yield "No models have new versions"
-        return
 
+    # The whole grid is rebuilt for every update, so new cards are shown at
+    # most once per interval instead of once per version found.
     articles = []
-    count = 0
-    for index, new_version in enumerate(new_versions):
-        article = build_article_from_version(new_version)
-        articles.append(article)
+    rendered = 0
+    last_render = time.monotonic()
+    for new_version in civitai.iter_models_new_version_by_model_types(model_types, progress):
+        articles.append(build_article_from_version(new_version))
+
+        if time.monotonic() - last_render >= UPDATE_RENDER_INTERVAL:
+            rendered = len(articles)
+            last_render = time.monotonic()
+            yield templates.update_card_grid.substitute(cards="".join(articles))
+
+    count = len(articles)
 
-    output = templates.update_card_grid.substitute(cards="".join(articles))
+    if count != rendered:
+        yield templates.update_card_grid.substitute(cards="".join(articles))
 
-    count = index + 1
+    if count == 0:
+        util.printD("Done: no new versions found.")
+        yield "No models have new versions"
+        return
 
     if count != 1:
         util.printD(f"Done. Found {count} models that have new versions. Check UI for detail")
     else:
         util.printD(f"Done. Found {count} model that has a new version. Check UI for detail.")
 
-    yield output
+
+def saved_new_versions_to_md() -> str:
+    new_versions = update_cache.get_saved_new_versions()
+
+    if not new_versions:
+        return ""
+
+    articles = [build_article_from_version(new_version) for new_version in new_versions]
+
+    return templates.update_card_grid.substitute(cards="".join(articles))
 
 
 def get_model_info_by_id(model_id:str) -> dict:
@@ -486,13 +592,42 @@ def parse_file_info(file_info, basename):
         # basename already includes extension (e.g. "mymodel.safetensors")
         filename = basename
 
+    sha256 = file_info.get("hashes", {}).get("SHA256", None)
+
     return {
         "url": download_url,
         "filename": filename,
-        "type": filetype
+        "type": filetype,
+        "sha256": sha256
     }
 
 
+def materialize_from_store(dl_info, dl_folder):
+
+    if not (dl_info["sha256"] and dl_info["filename"]):
+        return None
+
+    source = content_store.lookup(dl_info["sha256"])
+    if not source:
+        return None
+
+    target = os.path.join(dl_folder, dl_info["filename"])
+    if os.path.exists(target):
+        return None
+
+    try:
+        method = content_store.materialize(source, target)
+    except OSError as e:
+        util.printD(f"Could not reuse local copy {source}: {e}")
+        return None
+
+    util.printD(f"Reused local copy of {dl_info['filename']} ({method}): {source}")
+    content_store.register(dl_info["sha256"], target)
+    content_store.save()
+
+    return target
+
+
 def download_files(filename, model_folder, ver_info, headers, filetypes, dl_all, duplicate):
 
     version_id = ver_info["id"]
@@ -544,6 +679,13 @@ def download_files(filename, model_folder, ver_info, headers, filetypes, dl_all,
         if dl_info["type"] == "VAE":
             dl_folder = model.folders["vae"]
 
+        local_copy = materialize_from_store(dl_info, dl_folder)
+        if local_copy:
+            yield f"Found a local copy of {dl_info['filename']} | {index+1}/{total} files"
+            if dl_info["type"] == "Model":
+                filepath = local_copy
+            continue
+
         for result in downloader.dl_file(
             url, filename=dl_info["filename"], folder=dl_folder, duplicate=duplicate,
             headers=headers
@@ -563,6 +705,9 @@ def download_files(filename, model_folder, ver_info, headers, filetypes, dl_all,
             errors_count += 1
             continue
 
+        content_store.register(dl_info["sha256"], output)
+        content_store.save()
+
         if dl_info["type"] == "Model":
             filepath = output
 
@@ -615,7 +760,8 @@ def dl_model_by_input(
     dl_all:bool,
     duplicate:str,
     preview:str,
-    *args
+    *args,
+    on_transferred=None
 ) -> str:
 
     model_info = ch_state["model_info"]
@@ -729,9 +875,16 @@ def dl_model_by_input(
         yield output
         return
 
+    if on_transferred is not None:
+        on_transferred()
+
     version_info = civitai.get_version_info_by_version_id(ver_info["id"])
     model.process_model_info(output, version_info, model_type)
 
+    # A downloaded version is no longer offered as new
+    update_cache.remove_new_version(ver_info["id"])
+    update_cache.save()
+
     for result in civitai.get_preview_image_by_model_path(
         output,
         max_size_preview,
@@ -745,3 +898,102 @@ def dl_model_by_input(
         output = f"{output}. Additionally, the following failures occurred: \n{additional}"
     util.printD(output)
     yield output
+
+
+def enqueue_model_download(
+    model_info:dict,
+    model_type:str,
+    subfolder_str:str,
+    version_str:str,
+    filename:str,
+    file_ext:str,
+    dl_all:bool,
+    duplicate:str,
+    preview:str,
+    filetypes:list,
+    priority:int=0
+) -> str:
+
+    args = {
+        "model_id": model_info["id"],
+        "model_type": model_type,
+        "subfolder_str": subfolder_str,
+        "version_str": version_str,
+        "filename": filename,
+        "file_ext": file_ext,
+        "dl_all": dl_all,
+        "duplicate": duplicate,
+        "preview": preview,
+        "filetypes": list(filetypes),
+    }
+
+    return dl_queue.enqueue(
+        "model",
+        f"{model_info.get('name', model_info['id'])} ({version_str})",
+        args,
+        priority=priority,
+        memo={"model_info": model_info}
+    )
+
+
+def run_model_download_job(job:dict):
+    args = job["args"]
+    memo = job.setdefault("_memo", {})
+
+    model_info = memo.get("model_info", None)
+    if not model_info:
+        yield "Requesting model information from Civitai"
+        model_info = civitai.get_model_info_by_id(args["model_id"])
+        if not model_info:
+            raise dl_queue.JobFailed(f"Failed to get model info for {args['model_id']}")
+        memo["model_info"] = model_info
+
+    output = ""
+    for output in dl_model_by_input(
+        {"model_info": model_info},
+        args["model_type"],
+        args["subfolder_str"],
+        args["version_str"],
+        args["filename"],
+        args["file_ext"],
+        args["dl_all"],
+        args["duplicate"],
+        args["preview"],
+        *args["filetypes"],
+        on_transferred=lambda: dl_queue.release_slot(job)
+    ):
+        yield output
+
+    if not output.startswith("Done."):
+        raise dl_queue.JobFailed(output)
+
+
+def queue_dl_model_by_input(
+    ch_state:dict,
+    model_type:str,
+    subfolder_str:str,
+    version_str:str,
+    filename:str,
+    file_ext:str,
+    dl_all:bool,
+    duplicate:str,
+    preview:str,
+    *args
+) -> str:
+
+    model_info = ch_state["model_info"]
+    if not model_info:
+        output = "Missing model info. Get model info by Civitai Url first."
+        util.printD(output)
+        yield output
+        return
+
+    job_id = enqueue_model_download(
+        model_info, model_type, subfolder_str, version_str, filename,
+        file_ext, dl_all, duplicate, preview, args, priority=1
+    )
+
+    yield from dl_queue.watch_job(job_id)
+
+
+dl_queue.register_runner("model", run_model_download_job)
@@ -0,0 +1,104 @@
+from __future__ import annotations
+import threading
+import time
+
+
+# Weight of the newest sample in the smoothed transfer rate.
+RATE_SMOOTHING = 0.3
+
+transfers = {}
+# job id: partial download paths, removed if the job is cancelled
+partials = {}
+lock = threading.Lock()
+local = threading.local()
+
+
+def bind(job_id:str | None) -> None:
+    # Downloads started from this thread report to the given job.
+    local.job_id = job_id
+
+
+def update(done:int, total:int) -> None:
+    job_id = getattr(local, "job_id", None)
+    if job_id is None:
+        return
+
+    now = time.monotonic()
+
+    with lock:
+        transfer = transfers.get(job_id, None)
+
+        # Jobs may fetch several files; each one starts a new transfer.
+        if transfer is None or transfer["total"] != total or done < transfer["done"]:
+            transfers[job_id] = {
+                "done": done,
+                "total": total,
+                "rate": 0.0,
+                "time": now,
+            }
+            return
+
+        elapsed = now - transfer["time"]
+        if elapsed <= 0:
+            return
+
+        rate = (done - transfer["done"]) / elapsed
+        if transfer["rate"]:
+            rate = transfer["rate"] + RATE_SMOOTHING * (rate - transfer["rate"])
+
+        transfer["done"] = done
+        transfer["rate"] = rate
+        transfer["time"] = now
+
+
+def add_partial(dl_path:str) -> None:
+    job_id = getattr(local, "job_id", None)
+    if job_id is None:
+        return
+
+    with lock:
+        partials.setdefault(job_id, set()).add(dl_path)
+
+
+def pop_partials(job_id:str) -> set:
+    with lock:
+        return partials.pop(job_id, set())
+
+
+def get(job_id:str) -> dict | None:
+    with lock:
+        transfer = transfers.get(job_id, None)
+        if transfer is None:
+            return None
+
+        transfer = dict(transfer)
+
+    transfer["eta"] = get_eta(transfer["total"] - transfer["done"], transfer["rate"])
+    return transfer
+
+
+def clear(job_id:str) -> None:
+    with lock:
+        transfers.pop(job_id, None)
+
+
+def get_eta(remaining:int, rate:float) -> float | None:
+    if rate <= 0:
+        return None
+
+    return remaining / rate
+
+
+def summarize(job_ids:list) -> dict:
+    total = {"done": 0, "total": 0, "rate": 0.0}
+
+    for job_id in job_ids:
+        transfer = get(job_id)
+        if transfer is None:
+            continue
+
+        for key in total:
+            total[key] += transfer[key]
+
+    total["eta"] = get_eta(total["total"] - total["done"], total["rate"])
+    return total
@@ -0,0 +1,144 @@
+from __future__ import annotations
+import random
+import threading
+import time
+import urllib.parse
+from email.utils import parsedate_to_datetime
+from . import util
+
+
+DEFAULT_RATE = 4.0
+MIN_RATE = 0.25
+RATE_STEP = 0.1
+BURST = 4
+
+JITTER = 0.25
+MAX_BACKOFF = 60
+
+FAILURE_THRESHOLD = 5
+COOLDOWN = 120
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+
+    def __init__(self, host:str, rate:float=DEFAULT_RATE, burst:int=BURST):
+        self.host = host
+        self.lock = threading.Lock()
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def _refill(self, now:float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _circuit_open(self, now:float) -> bool:
+        if self.opened_at is None:
+            return False
+
+        if now - self.opened_at < COOLDOWN:
+            return True
+
+        # Half open: let a single request through to probe the service.
+        if self.probing:
+            return True
+
+        self.probing = True
+        return False
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.opened_at is not None \
+                and time.monotonic() - self.opened_at < COOLDOWN
+
+    def acquire(self) -> bool:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self._circuit_open(now):
+                    return False
+
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait + random.uniform(0, wait * JITTER))
+
+    def success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.rate = min(self.max_rate, self.rate + RATE_STEP)
+
+    def failure(self, retry_after:float | None=None) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.failures += 1
+            self.rate = max(MIN_RATE, self.rate / 2)
+
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+            if self.probing or self.failures >= FAILURE_THRESHOLD:
+                if self.opened_at is None or self.probing:
+                    util.printD(
+                        f"Too many failed requests to {self.host}. "
+                        f"Pausing requests for {COOLDOWN} seconds."
+                    )
+                self.opened_at = now
+                self.probing = False
+
+    def backoff(self, retries:int) -> float:
+        with self.lock:
+            blocked = self.blocked_until - time.monotonic()
+
+        delay = min(MAX_BACKOFF, 2 ** retries)
+        delay = random.uniform(delay / 2, delay)
+
+        return max(delay, blocked)
+
+
+def get_limiter(url:str) -> RateLimiter:
+    host = urllib.parse.urlparse(url).netloc
+
+    with limiters_lock:
+        limiter = limiters.get(host, None)
+        if limiter is None:
+            limiter = limiters[host] = RateLimiter(host)
+
+    return limiter
+
+
+def circuit_open(url:str) -> bool:
+    return get_limiter(url).is_open()
+
+
+def parse_retry_after(value:str | None) -> float | None:
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, retry_at - time.time())
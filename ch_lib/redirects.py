@@ -0,0 +1,95 @@
+from __future__ import annotations
+import datetime
+import threading
+import time
+import urllib.parse
+from . import util
+
+
+# Used when a signed URL doesn't say when it expires.
+DEFAULT_TTL = 300
+# Stop using a URL this long before it expires, so a request never starts
+# with a URL that is about to stop working.
+EXPIRY_MARGIN = 30
+
+cache = {}
+lock = threading.Lock()
+
+
+def parse_expiry(resolved_url:str) -> float | None:
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(resolved_url).query)
+
+    try:
+        # S3 style: X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600
+        if "X-Amz-Date" in query and "X-Amz-Expires" in query:
+            signed = datetime.datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ")
+            signed = signed.replace(tzinfo=datetime.timezone.utc)
+            return signed.timestamp() + int(query["X-Amz-Expires"][0])
+
+        # CloudFront and most others: an absolute unix timestamp
+        for key in ("Expires", "expires", "exp"):
+            if key in query:
+                return float(query[key][0])
+
+    except ValueError:
+        pass
+
+    return None
+
+
+def remember(url:str, resolved_url:str | None, expires:float | None=None) -> None:
+    if not resolved_url or resolved_url == url:
+        return
+
+    if not expires:
+        expires = parse_expiry(resolved_url) or time.time() + DEFAULT_TTL
+
+    with lock:
+        cache[url] = (resolved_url, expires)
+
+
+def restore(url:str, state:dict | None) -> None:
+    # Pick up the URL a partial download was using before webui restarted.
+    if not state or state.get("url", None) != url:
+        return
+
+    expires = state.get("resolved_expires", None)
+    if expires:
+        remember(url, state.get("resolved_url", None), expires)
+
+
+def get(url:str) -> str | None:
+    with lock:
+        entry = cache.get(url, None)
+        if entry is None:
+            return None
+
+        resolved_url, expires = entry
+        if expires - EXPIRY_MARGIN > time.time():
+            return resolved_url
+
+        del cache[url]
+
+    return None
+
+
+def get_expiry(url:str) -> float | None:
+    with lock:
+        entry = cache.get(url, None)
+
+    return entry[1] if entry else None
+
+
+def invalidate(url:str) -> None:
+    with lock:
+        if cache.pop(url, None):
+            util.printD(f"Dropped cached download location for {url}")
+
+
+def headers_for(url:str, resolved_url:str, headers:dict) -> dict:
+    # Signed CDN URLs carry their own authorization and reject requests that
+    # also send the API key, the same way requests drops it on redirects.
+    if urllib.parse.urlparse(url).netloc == urllib.parse.urlparse(resolved_url).netloc:
+        return headers
+
+    return {key: val for key, val in headers.items() if key.lower() != "authorization"}
@@ -0,0 +1,109 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from . import util
+
+
+CACHE_DIR = "responses"
+QUEUE_FILE = "offline_queue.json"
+
+# Queued lookups that still fail after this many online attempts, like
+# deleted models, are dropped from the queue.
+MAX_RESOLVE_ATTEMPTS = 3
+
+lock = threading.Lock()
+
+
+def get_cache_path(url:str) -> str:
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return util.get_data_path(CACHE_DIR, key[:2], f"{key}.json.gz")
+
+
+def get(url:str):
+    path = get_cache_path(url)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as cache_file:
+            return json.load(cache_file)
+
+    except (OSError, ValueError) as e:
+        util.printD(f"Could not read cached response for {url}: {e}")
+        return None
+
+
+def put(url:str, content) -> None:
+    path = get_cache_path(url)
+    tmp_path = f"{path}.tmp"
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as cache_file:
+            json.dump(content, cache_file)
+        os.replace(tmp_path, path)
+
+    except OSError as e:
+        util.printD(f"Could not cache response for {url}: {e}")
+
+
+def _load_queue(path:str) -> dict:
+    # url: failed attempts to resolve it
+    queue = util.load_json(path, {})
+
+    # Older queues were a plain list of URLs
+    if isinstance(queue, list):
+        queue = dict.fromkeys(queue, 0)
+
+    return queue
+
+
+def queue_miss(url:str) -> None:
+    util.printD(f"Offline mode: no cached response, queued for later: {url}")
+
+    path = util.get_data_path(QUEUE_FILE)
+    with lock:
+        queue = _load_queue(path)
+        if url in queue:
+            return
+
+        queue[url] = 0
+        util.write_json(path, queue)
+
+
+def get_queue() -> list:
+    with lock:
+        return list(_load_queue(util.get_data_path(QUEUE_FILE)))
+
+
+def remove_from_queue(url:str) -> None:
+    path = util.get_data_path(QUEUE_FILE)
+    with lock:
+        queue = _load_queue(path)
+        if url not in queue:
+            return
+
+        queue.pop(url)
+        util.write_json(path, queue)
+
+
+def record_failure(url:str) -> bool:
+    # Returns True if the lookup was dropped from the queue.
+    path = util.get_data_path(QUEUE_FILE)
+    with lock:
+        queue = _load_queue(path)
+        if url not in queue:
+            return False
+
+        attempts = queue[url] + 1
+        dropped = attempts >= MAX_RESOLVE_ATTEMPTS
+        if dropped:
+            queue.pop(url)
+        else:
+            queue[url] = attempts
+
+        util.write_json(path, queue)
+
+    return dropped
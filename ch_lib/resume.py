@@ -0,0 +1,161 @@
+from __future__ import annotations
+import hashlib
+import os
+from . import util
+
+
+RESUME_EXT = ".resume"
+
+# Bytes just before each segment's resume point that are checksummed, so a
+# partial file that was modified or truncated is not silently continued.
+CHECK_SIZE = 64 * 1024
+
+
+def get_resume_path(dl_path:str) -> str:
+    return f"{dl_path}{RESUME_EXT}"
+
+
+def new_state(remote:dict | None, total_size:int, segments:list[list[int]]) -> dict:
+    remote = remote or {}
+    return {
+        "url": remote.get("url", None),
+        "resolved_url": remote.get("resolved_url", None),
+        "resolved_expires": remote.get("resolved_expires", None),
+        "etag": remote.get("etag", None),
+        "last_modified": remote.get("last_modified", None),
+        "size": total_size,
+        # [first byte, last byte, bytes downloaded]
+        "segments": segments,
+        # [bytes downloaded, sha256 of the CHECK_SIZE bytes before that point]
+        "checks": [None] * len(segments),
+    }
+
+
+def read(dl_path:str) -> dict | None:
+    if not os.path.exists(dl_path):
+        return None
+
+    state = util.load_json(get_resume_path(dl_path), None)
+    if not isinstance(state, dict) or "segments" not in state:
+        return None
+
+    return state
+
+
+def load(dl_path:str) -> dict | None:
+    state = read(dl_path)
+    if state is None:
+        return None
+
+    verify(dl_path, state)
+
+    return state
+
+
+def save(dl_path:str, state:dict) -> None:
+    try:
+        util.write_json(get_resume_path(dl_path), state)
+    except OSError as e:
+        util.printD(f"Could not save resume data for {dl_path}: {e}")
+
+
+def checkpoint(dl_path:str, state:dict) -> None:
+    # Record checksums for the data written so far, then save. Only call this
+    # once everything up to each segment's progress has been written out.
+    try:
+        with open(dl_path, "rb") as partial:
+            state["checks"] = [
+                [segment[2], tail_hash(partial, segment[0], segment[2])] if segment[2] else None
+                for segment in state["segments"]
+            ]
+    except OSError as e:
+        util.printD(f"Could not checksum partial download {dl_path}: {e}")
+
+    save(dl_path, state)
+
+
+def remove(dl_path:str) -> None:
+    resume_path = get_resume_path(dl_path)
+    if os.path.isfile(resume_path):
+        os.remove(resume_path)
+
+
+def discard(dl_path:str) -> None:
+    if os.path.isfile(dl_path):
+        os.remove(dl_path)
+    remove(dl_path)
+
+
+def tail_hash(partial, start:int, done:int) -> str:
+    offset = max(start, start + done - CHECK_SIZE)
+    partial.seek(offset)
+    return hashlib.sha256(partial.read(start + done - offset)).hexdigest()
+
+
+def verify(dl_path:str, state:dict) -> None:
+    # Segments whose data no longer matches their checksum start over.
+    segments = state["segments"]
+    checks = state.get("checks", None) or [None] * len(segments)
+    file_size = os.path.getsize(dl_path)
+
+    with open(dl_path, "rb") as partial:
+        for index, segment in enumerate(segments):
+            start, _, done = segment
+            if not done:
+                continue
+
+            check = checks[index] if index < len(checks) else None
+            valid = (
+                check is not None
+                and check[0] == done
+                and start + done <= file_size
+                and tail_hash(partial, start, done) == check[1]
+            )
+
+            if not valid:
+                util.printD(f"Partial data at byte {start} does not match resume data, downloading it again.")
+                segment[2] = 0
+
+
+def matches(state:dict, remote:dict | None, total_size:int) -> bool:
+    # Compare the saved download against what the server reports now.
+    if state.get("size", None) != total_size:
+        return False
+
+    if not remote:
+        return True
+
+    if state.get("url", None) and remote.get("url", None) and state["url"] != remote["url"]:
+        return False
+
+    for key in ("etag", "last_modified"):
+        if state.get(key, None) and remote.get(key, None):
+            return state[key] == remote[key]
+
+    return True
+
+
+def validator(state:dict) -> str | None:
+    # Value for an If-Range header: a strong ETag, or else Last-Modified.
+    etag = state.get("etag", None)
+    if etag and not etag.startswith("W/"):
+        return etag
+
+    return state.get("last_modified", None)
+
+
+def plan_segments(total_size:int, count:int) -> list[list[int]]:
+    count = max(1, min(count, total_size))
+    size = total_size // count
+
+    segments = []
+    for index in range(count):
+        start = index * size
+        end = total_size - 1 if index == count - 1 else start + size - 1
+        segments.append([start, end, 0])
+
+    return segments
+
+
+def downloaded(state:dict) -> int:
+    return sum(segment[2] for segment in state["segments"])
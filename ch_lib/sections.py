@@ -1,13 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import gradio as gr
 from . import model
 from . import js_action_civitai
 from . import model_action_civitai
 from . import civitai
 from . import duplicate_check
+from . import dl_queue
+from . import downloader
+from . import progress
 from . import util
 
 model_types = list(model.folders.keys())
 
+BATCH_RESOLVE_WORKERS = 4
+# The batch status only lists this many finished downloads and errors, so it
+# costs the same to draw after ten downloads as after a thousand.
+BATCH_RECENT_RESULTS = 10
+
+
+def format_eta(seconds) -> str:
+    if seconds is None:
+        return "--:--"
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+def format_transfer(transfer:dict) -> str:
+    total = transfer["total"]
+    percent = int(100 * transfer["done"] / total) if total else 0
+    done = downloader.human_readable_filesize(transfer["done"])
+    size = downloader.human_readable_filesize(total)
+    rate = downloader.human_readable_filesize(transfer["rate"])
+
+    return f"{percent}%: {done}B / {size}B @ {rate}Bps, ETA {format_eta(transfer['eta'])}"
+
+
+def format_job_progress(job:dict) -> str:
+    if job["state"] == dl_queue.RUNNING and job.get("transfer", None):
+        return format_transfer(job["transfer"])
+
+    return job["result"] or job["progress"]
+
+
 def scan_models_section():
     with gr.Row():
         pass
@@ -45,6 +84,32 @@ def scan_models_section():
             elem_id="ch_scan_model_log_md"
         )
 
+    with gr.Accordion("Offline Lookups", open=False):
+        gr.Markdown(
+            "Lookups that missed the local cache while offline mode was enabled. "
+            "Resolve them on a connected machine to fill the cache."
+        )
+        with gr.Row():
+            resolve_offline_queue_btn = gr.Button(
+                value="Resolve Queued Lookups",
+                elem_id="ch_resolve_offline_queue_btn"
+            )
+        with gr.Row():
+            resolve_offline_queue_log_md = gr.Markdown(value="")
+
+    with gr.Accordion("Shared Example Images", open=False):
+        gr.Markdown(
+            "Replace identical example images of the selected model types with links "
+            "to one file, and record them so new downloads of the same images are linked too."
+        )
+        with gr.Row():
+            dedupe_examples_btn = gr.Button(
+                value="Reconcile Example Images",
+                elem_id="ch_dedupe_examples_btn"
+            )
+        with gr.Row():
+            dedupe_examples_log_md = gr.Markdown(value="")
+
     scan_model_civitai_btn.click(
         model_action_civitai.scan_model,
         inputs=[
@@ -55,6 +120,18 @@ def scan_models_section():
         outputs=scan_model_log_md
     )
 
+    resolve_offline_queue_btn.click(
+        civitai.resolve_offline_queue,
+        inputs=None,
+        outputs=resolve_offline_queue_log_md
+    )
+
+    dedupe_examples_btn.click(
+        model_action_civitai.dedupe_example_images,
+        inputs=scan_model_types_drop,
+        outputs=dedupe_examples_log_md
+    )
+
 
 def get_model_info_by_url_section():
 
@@ -593,7 +670,7 @@ def download_section():
         ] + ch_dl_model_types
 
     dl_civitai_model_by_id_btn.click(
-        model_action_civitai.dl_model_by_input,
+        model_action_civitai.queue_dl_model_by_input,
         inputs=dl_inputs,
         outputs=dl_log_md
     )
@@ -746,119 +823,179 @@ def download_multiple_section():
 
         return options
 
-    def download_all_action(entries_txt:str):
-        entries_txt = entries_txt.strip()
-        entries = entries_txt.split("\n")
-        dls = []
+    def resolve_entry(entry:str, nsfw_preview_threshold) -> list:
+        url = None
+        params = None
+        options = None
 
-        nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
+        if "::" in entry:
+            params = entry.split("::")
+            url = params.pop(0)
+        else:
+            params = []
+            url = entry
+
+        options = parse_params(params)
+
+        result = civitai.get_model_id_from_url(url, include_model_ver=True)
+
+        if not result:
+            return []
+
+        model_id, model_version_id = result
+        model_info = civitai.get_model_info_by_id(model_id)
+
+        if not model_info:
+            return []
+
+        dl = {
+            "model_name": model_info["name"],
+            "model_info": model_info,
+            "model_type": civitai.MODEL_TYPES[model_info["type"]],
+            "subfolder": f"/{options['subdirectory'] or ''}",
+            "version_str": None,
+            "filename": None,
+            "file_ext": None,
+            "dl_all": options["all_files"],
+            "nsfw_preview_threshold": nsfw_preview_threshold,
+            "duplicate": "skip",
+            "preview": None,
+            "filetypes": None
+        }
 
-        for entry in entries:
-            url = None
-            params = None
-            options = None
+        model_version = None
 
-            if "::" in entry:
-                params = entry.split("::")
-                url = params.pop(0)
-            else:
-                params = []
-                url = entry
+        if options["all_versions"]:
+            return [
+                append_model_version_info(dl.copy(), model_version)
+                for model_version in model_info["modelVersions"]
+            ]
 
-            options = parse_params(params)
+        try:
+            if model_version_id:
+                for version in model_info["modelVersions"]:
+                    if f"{version['id']}" == model_version_id:
+                        model_version = version
+                        break
 
-            result = civitai.get_model_id_from_url(url, include_model_ver=True)
+        except KeyError:
+            util.printD(f"Failed to find a model version for model {model_id}")
+            return []
+
+        if not model_version:
+            model_version = model_info["modelVersions"][0]
+
+        dl = append_model_version_info(dl, model_version)
+        if not dl:
+            return []
+
+        return [dl]
+
+    def enqueue_dl(dl:dict) -> str:
+        return model_action_civitai.enqueue_model_download(
+            dl["model_info"],
+            dl["model_type"],
+            dl["subfolder"],
+            dl["version_str"],
+            dl["filename"],
+            dl["file_ext"],
+            dl["dl_all"],
+            dl["duplicate"],
+            dl["preview"],
+            dl["filetypes"]
+        )
 
-            if not result:
-                continue
+    def render_batch_status(jobs:list, resolving:int, errors:list) -> str:
+        counts = {}
+        running = []
+        finished = []
+        for job in jobs:
+            counts[job["state"]] = counts.get(job["state"], 0) + 1
+            if job["state"] == dl_queue.RUNNING:
+                running.append(job)
+            elif job["state"] in dl_queue.FINISHED_STATES:
+                finished.append(job)
+
+        totals = progress.summarize([job["id"] for job in running])
+
+        summary = ", ".join(
+            f"{counts.get(state, 0)} {state}"
+            for state in (
+                dl_queue.DONE, dl_queue.FAILED, dl_queue.CANCELLED,
+                dl_queue.PAUSED, dl_queue.RUNNING, dl_queue.QUEUED
+            )
+        )
+        if errors:
+            summary += f", {len(errors)} could not be resolved"
+        if resolving:
+            summary += f", resolving {resolving} more entries"
 
-            model_id, model_version_id = result
-            model_info = civitai.get_model_info_by_id(model_id)
+        lines = [f"Downloads: {summary}"]
+        if totals["total"]:
+            lines.append(f"Transferring: {format_transfer(totals)}")
 
-            if not model_info:
-                continue
+        for job in running:
+            lines.append(f" * {job['name']}: {format_job_progress(job)}")
 
-            dl = {
-                "model_name": model_info["name"],
-                "model_info": model_info,
-                "model_type": civitai.MODEL_TYPES[model_info["type"]],
-                "subfolder": f"/{options['subdirectory'] or ''}",
-                "version_str": None,
-                "filename": None,
-                "file_ext": None,
-                "dl_all": options["all_files"],
-                "nsfw_preview_threshold": nsfw_preview_threshold,
-                "duplicate": "skip",
-                "preview": None,
-                "filetypes": None
-            }
-
-            model_version = None
-
-            if options["all_versions"]:
-                for model_version in model_info["modelVersions"]:
-                    dl_version = append_model_version_info(dl.copy(), model_version)
-                    dls.append(dl_version)
+        recent = sorted(finished, key=lambda job: job.get("finished", 0))[-BATCH_RECENT_RESULTS:]
+        if recent:
+            lines.append("")
+            lines.append(f"Last {len(recent)} of {len(finished)} finished:")
+            for job in recent:
+                result = job["result"].replace("\n", " ")
+                lines.append(f" * {job['name']}: {result}")
 
-                continue
+        if errors:
+            lines.append("")
+            lines += errors[-BATCH_RECENT_RESULTS:]
 
-            try:
-                if model_version_id:
-                    for version in model_info["modelVersions"]:
-                        if f"{version['id']}" == model_version_id:
-                            model_version = version
-                            break
+        status = "\n".join(lines)
+        return f"```\n{status}\n```"
 
-            except KeyError:
-                util.printD(f"Failed to find a model version for model {model_id}")
-                continue
+    def download_all_action(entries_txt:str):
+        entries_txt = entries_txt.strip()
+        entries = [entry for entry in entries_txt.split("\n") if entry.strip()]
+
+        nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
 
-            if not model_version:
-                model_version = model_info["modelVersions"][0]
+        job_ids = []
+        errors = []
 
-            dl = append_model_version_info(dl, model_version)
-            if not dl:
-                continue
+        # The batch's jobs are pinned until the batch is reported, so
+        # finished ones are not pruned from the queue while it is shown.
+        try:
+            # Entries are resolved in parallel and each one is queued as soon as it
+            # resolves, so the first download starts without waiting for the rest.
+            with ThreadPoolExecutor(max_workers=BATCH_RESOLVE_WORKERS) as pool:
+                pending = {
+                    pool.submit(resolve_entry, entry, nsfw_preview_threshold): entry
+                    for entry in entries
+                }
 
-            dls.append(dl)
-
-        i = 0
-        count = len(dls)
-        download_results = []
-        for dl in dls:
-            i = i + 1
-            progress = None
-            try:
-                dl_status = "\n".join(download_results)
-                status_msg = f"```\nCompleted:\n{dl_status}\n```"
-                for progress in model_action_civitai.dl_model_by_input(
-                    {"model_info": dl["model_info"]},
-                    dl["model_type"],
-                    dl["subfolder"],
-                    dl["version_str"],
-                    dl["filename"],
-                    dl["file_ext"],
-                    dl["dl_all"],
-                    dl["duplicate"],
-                    dl["preview"],
-                    *dl["filetypes"]
-                ):
-                    yield f"{dl['model_name']} {i}/{count} {progress} \n {status_msg}"
-
-                download_results.append(f"{dl['model_name']}: {progress}")
-            except Exception as e:
-                msg = None
-                if hasattr(e, 'message'):
-                    msg = e.message
-                else:
-                    msg = e
+                while pending:
+                    done, _ = wait(pending, timeout=dl_queue.WATCH_INTERVAL, return_when=FIRST_COMPLETED)
 
-                output = f"An error has occurred while downloading: {msg}\n{e.args}"
-                util.printD(output)
-                download_results.append(f" * {dl['model_name']}: {output}")
+                    for future in done:
+                        entry = pending.pop(future)
+                        try:
+                            for dl in future.result():
+                                job_id = enqueue_dl(dl)
+                                dl_queue.pin([job_id])
+                                job_ids.append(job_id)
+
+                        except Exception as e:
+                            output = f"An error has occurred while resolving {entry}: {e}"
+                            util.printD(output)
+                            errors.append(f" * {output}")
+
+                    yield render_batch_status(dl_queue.get_jobs(job_ids), len(pending), errors)
+
+            for jobs in dl_queue.watch(job_ids):
+                yield render_batch_status(jobs, 0, errors)
+
+        finally:
+            dl_queue.unpin(job_ids)
 
-        download_results = "\n".join(download_results)
-        yield f"```\nCompleted:\n{download_results}\n```"
         return
 
     with gr.Row():
@@ -1005,7 +1142,7 @@ def check_new_versions_section(js_msg_txtbox):
             with gr.Column():
                 dl_new_version_log_md = gr.Markdown()
                 check_models_new_version_log_md = gr.HTML(
-                    "",
+                    model_action_civitai.saved_new_versions_to_md,
                     elem_id="ch_check_models_new_version_log_md"
                 )
 
@@ -1028,3 +1165,95 @@ def check_new_versions_section(js_msg_txtbox):
         ],
         outputs=dl_new_version_log_md
     )
+
+
+def download_queue_section():
+
+    def render_jobs():
+        jobs = dl_queue.get_jobs()
+        if not jobs:
+            return "The download queue is empty."
+
+        rows = [
+            "| ID | Model | State | Priority | Progress |",
+            "| --- | --- | --- | --- | --- |"
+        ]
+        for job in reversed(jobs):
+            job_progress = format_job_progress(job)
+            job_progress = job_progress.replace("\n", " ").replace("|", "\\|")
+            rows.append(
+                f"| `{job['id']}` | {job['name']} | {job['state']} | {job['priority']} | {job_progress} |"
+            )
+
+        return "\n".join(rows)
+
+    def run_action(action, job_id):
+        job_id = job_id.strip()
+        if not action(job_id):
+            util.printD(f"Could not update download job: {job_id}")
+
+        return render_jobs()
+
+    def change_priority(job_id, priority):
+        return run_action(lambda job_id: dl_queue.set_priority(job_id, priority), job_id)
+
+    def clear_finished():
+        dl_queue.clear_finished()
+        return render_jobs()
+
+    with gr.Row():
+        with gr.Column(scale=2, elem_classes="justify-bottom"):
+            job_id_txtbox = gr.Textbox(
+                label="Job ID",
+                lines=1,
+                max_lines=1,
+                value=""
+            )
+        with gr.Column(scale=1, elem_classes="justify-bottom"):
+            priority_num = gr.Number(
+                label="Priority",
+                value=0,
+                precision=0
+            )
+    with gr.Row():
+        pause_btn = gr.Button(value="Pause")
+        resume_btn = gr.Button(value="Resume")
+        cancel_btn = gr.Button(value="Cancel")
+        priority_btn = gr.Button(value="Set Priority")
+    with gr.Row():
+        refresh_btn = gr.Button(value="Refresh", variant="primary")
+        clear_btn = gr.Button(value="Clear Finished")
+
+    with gr.Row():
+        queue_md = gr.Markdown(value=render_jobs)
+
+    pause_btn.click(
+        lambda job_id: run_action(dl_queue.pause, job_id),
+        inputs=job_id_txtbox,
+        outputs=queue_md
+    )
+    resume_btn.click(
+        lambda job_id: run_action(dl_queue.resume, job_id),
+        inputs=job_id_txtbox,
+        outputs=queue_md
+    )
+    cancel_btn.click(
+        lambda job_id: run_action(dl_queue.cancel, job_id),
+        inputs=job_id_txtbox,
+        outputs=queue_md
+    )
+    priority_btn.click(
+        change_priority,
+        inputs=[job_id_txtbox, priority_num],
+        outputs=queue_md
+    )
+    refresh_btn.click(
+        render_jobs,
+        inputs=None,
+        outputs=queue_md
+    )
+    clear_btn.click(
+        clear_finished,
+        inputs=None,
+        outputs=queue_md
+    )
@@ -0,0 +1,90 @@
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+from PIL import Image, ImageOps
+from . import util
+from . import dir_index
+
+
+THUMB_EXT = ".thumb.webp"
+THUMB_SIZE = 512
+THUMB_QUALITY = 80
+THUMB_WORKERS = 2
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+pool = None
+pending = set()
+lock = threading.Lock()
+
+
+def get_thumbnail_path(image_path:str) -> str:
+    base, _ = os.path.splitext(image_path)
+    return f"{base}{THUMB_EXT}"
+
+
+def is_thumbnail(path:str) -> bool:
+    return path.endswith(THUMB_EXT)
+
+
+def get_thumbnail(image_path:str) -> str | None:
+    # A thumbnail older than its image belongs to a replaced image.
+    thumb_path = get_thumbnail_path(image_path)
+    try:
+        if os.path.getmtime(thumb_path) >= os.path.getmtime(image_path):
+            return thumb_path
+    except OSError:
+        pass
+
+    return None
+
+
+def make_thumbnail(image_path:str) -> str | None:
+    thumb_path = get_thumbnail_path(image_path)
+    tmp_path = f"{thumb_path}.tmp"
+
+    try:
+        with Image.open(image_path) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+            image.save(tmp_path, "WEBP", quality=THUMB_QUALITY, method=4)
+
+        os.replace(tmp_path, thumb_path)
+        dir_index.add(thumb_path)
+
+    except (OSError, ValueError) as e:
+        util.printD(f"Could not create thumbnail for {image_path}: {e}")
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+    finally:
+        with lock:
+            pending.discard(image_path)
+
+    return thumb_path
+
+
+def queue(image_path:str) -> Future | None:
+    if not util.get_opts("ch_preview_thumbnails"):
+        return None
+
+    _, ext = os.path.splitext(image_path)
+    if ext.lower() not in IMAGE_EXTS or is_thumbnail(image_path):
+        return None
+
+    global pool
+
+    with lock:
+        if image_path in pending:
+            return None
+        pending.add(image_path)
+
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="ch_thumb")
+
+    return pool.submit(make_thumbnail, image_path)
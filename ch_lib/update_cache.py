@@ -0,0 +1,108 @@
+from __future__ import annotations
+import os
+import threading
+from . import util
+
+
+CACHE_FILE = "update_cache.json"
+
+records = None
+dirty = False
+lock = threading.Lock()
+
+
+def _load() -> dict:
+    global records
+
+    if records is None:
+        records = util.load_json(util.get_data_path(CACHE_FILE), {})
+
+    return records
+
+
+def get(model_id) -> dict:
+    with lock:
+        return _load().get(f"{model_id}", None)
+
+
+def put(model_id, record:dict) -> None:
+    global dirty
+
+    with lock:
+        _load()[f"{model_id}"] = record
+        dirty = True
+
+
+def touch(model_id) -> None:
+    global dirty
+
+    with lock:
+        record = _load().get(f"{model_id}", None)
+        if record is not None:
+            record["checked"] = util.ch_time()
+            dirty = True
+
+
+def save() -> None:
+    global dirty
+
+    with lock:
+        if not dirty:
+            return
+
+        util.write_json(util.get_data_path(CACHE_FILE), _load())
+        dirty = False
+
+
+def set_new_versions(model_id, versions:list) -> None:
+    global dirty
+
+    with lock:
+        record = _load().setdefault(f"{model_id}", {})
+        record["new_versions"] = versions
+        dirty = True
+
+
+def last_checked(model_id) -> int:
+    with lock:
+        record = _load().get(f"{model_id}", None)
+        if not record:
+            return 0
+
+        return record.get("checked", 0)
+
+
+def remove_new_version(version_id) -> None:
+    # Called once a new version was downloaded, so it is no longer listed
+    global dirty
+
+    with lock:
+        for record in _load().values():
+            versions = record.get("new_versions", [])
+            kept = [version for version in versions if f"{version[3]}" != f"{version_id}"]
+            if len(kept) != len(versions):
+                record["new_versions"] = kept
+                dirty = True
+
+
+def get_saved_new_versions() -> list:
+    with lock:
+        saved = [
+            version
+            for record in _load().values()
+            for version in record.get("new_versions", [])
+        ]
+
+    new_versions = []
+    new_version_ids = set()
+    for version in saved:
+        version = tuple(version)
+        model_path, version_id = version[0], version[3]
+
+        if version_id in new_version_ids or not os.path.isfile(model_path):
+            continue
+
+        new_version_ids.add(version_id)
+        new_versions.append(version)
+
+    return new_versions
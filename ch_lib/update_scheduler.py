@@ -0,0 +1,106 @@
+import threading
+from . import util
+from . import model
+from . import civitai
+from . import update_cache
+
+
+MIN_WAKE_SECONDS = 5 * 60
+SAVE_EVERY = 10
+
+DEFAULT_MODEL_TYPES = ["ckp", "lora", "lycoris", "ti"]
+
+stop_event = threading.Event()
+worker = None
+
+
+def get_interval() -> int:
+    hours = util.get_opts("ch_update_check_interval") or 0
+    return int(float(hours) * 60 * 60)
+
+
+def get_pace() -> float:
+    budget = util.get_opts("ch_update_check_budget") or 0
+    if float(budget) <= 0:
+        return 0
+
+    return 60 * 60 / float(budget)
+
+
+def get_model_types() -> list:
+    model_types = util.get_opts("ch_update_check_types")
+    if model_types is None:
+        model_types = DEFAULT_MODEL_TYPES
+
+    return [model_type for model_type in model_types if model_type in model.folders]
+
+
+def run_incremental_check(interval:int) -> int:
+    groups = civitai.group_models_by_model_id(get_model_types())
+    if not groups:
+        return interval
+
+    now = util.ch_time()
+    checked = {model_id: update_cache.last_checked(model_id) for model_id in groups}
+    due = sorted(
+        (model_id for model_id, last in checked.items() if now - last >= interval),
+        key=checked.get
+    )
+
+    if due:
+        util.printD(f"Background update check: {len(due)} of {len(groups)} models are due")
+
+    pace = get_pace()
+    for count, model_id in enumerate(due, start=1):
+        if stop_event.is_set() or not get_interval():
+            break
+
+        civitai.check_model_group_new_versions(model_id, groups[model_id])
+        checked[model_id] = util.ch_time()
+
+        if count % SAVE_EVERY == 0:
+            update_cache.save()
+
+        if stop_event.wait(pace):
+            break
+
+    update_cache.save()
+
+    oldest = min(checked.values())
+    return oldest + interval - util.ch_time()
+
+
+def run() -> None:
+    wait = MIN_WAKE_SECONDS
+    while not stop_event.wait(wait):
+        interval = get_interval()
+        if not interval:
+            wait = MIN_WAKE_SECONDS
+            continue
+
+        try:
+            wait = run_incremental_check(interval)
+        except Exception as e:
+            util.printD(f"Background update check failed: {e}")
+            wait = interval
+
+        wait = max(MIN_WAKE_SECONDS, wait)
+
+
+def start() -> None:
+    global worker
+
+    if worker is not None and worker.is_alive():
+        return
+
+    stop_event.clear()
+    worker = threading.Thread(target=run, name="ch_update_scheduler", daemon=True)
+    worker.start()
+
+
+def stop() -> None:
+    stop_event.set()
+
+
+def on_app_started(_demo, _app) -> None:
+    start()
@@ -2,6 +2,7 @@ from __future__ import annotations
 import os
 import io
 import re
+import json
 import hashlib
 import textwrap
 import time
@@ -41,6 +42,8 @@ GRADIO_FALLBACK = False
 
 script_dir = None
 
+DATA_DIR = "data"
+
 def printD(msg:any) -> str:
     print(f"[Civitai-Helper]: {msg}")
 
@@ -67,10 +70,6 @@ def indented_msg(msg:str) -> str:
     return msg
 
 
-def delay(seconds:float) -> None:
-    time.sleep(seconds)
-
-
 def is_stale(timestamp:float) -> bool:
     cur_time = ch_time()
     elapsed = cur_time - timestamp
@@ -111,6 +110,10 @@ def get_opts(key):
     return opts.data.get(key, None)
 
 
+def is_offline() -> bool:
+    return bool(get_opts("ch_offline_mode"))
+
+
 def gen_file_sha256(filename:str, model_type="lora", use_addnet_hash=False) -> str:
 
     cache = sha256_cache.cache
@@ -188,6 +191,35 @@ def read_chunks(file, size=io.DEFAULT_BUFFER_SIZE) -> bytes:
         yield chunk
 
 
+def get_data_path(*parts:str) -> str:
+    base = script_dir or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    folder = os.path.join(base, DATA_DIR)
+    os.makedirs(folder, exist_ok=True)
+
+    return os.path.join(folder, *parts)
+
+
+def load_json(path:str, default=None):
+    if not os.path.isfile(path):
+        return default
+
+    try:
+        with open(path, "r", encoding="utf-8") as json_file:
+            return json.load(json_file)
+
+    except (OSError, ValueError) as e:
+        printD(f"Could not read {path}: {e}")
+        return default
+
+
+def write_json(path:str, data) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file)
+
+    os.replace(tmp_path, path)
+
+
 def get_subfolders(folder:str) -> list[str]:
     printD(f"Get subfolder for: {folder}")
     if not folder:
@@ -9,6 +9,9 @@ from ch_lib import js_action_civitai
 from ch_lib import civitai
 from ch_lib import util
 from ch_lib import sections
+from ch_lib import update_scheduler
+from ch_lib import dl_queue
+from ch_lib import bandwidth
 from packaging.version import parse as parse_version
 
 try:
@@ -76,6 +79,8 @@ def on_ui_tabs():
                 sections.download_section()
             with gr.Tab("Batch Download"):
                 sections.download_multiple_section()
+            with gr.Tab("Queue"):
+                sections.download_queue_section()
 
         with gr.Accordion("📑 Scan Duplicates", open=False, elem_classes="ch_box"):
             sections.scan_for_duplicates_section()
@@ -249,6 +254,52 @@ def on_ui_settings():
             section=section
         )
     )
+    shared.opts.add_option(
+        "ch_lazy_examples",
+        shared.OptionInfo(
+            False,
+            (
+                "Download example images lazily: scans only record their URLs, "
+                "and images are fetched in the background or when a model is used"
+            ),
+            gr.Checkbox,
+            {"interactive": True},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_example_prefetch",
+        shared.OptionInfo(
+            3,
+            (
+                "Number of example images per model to prefetch in the background in lazy mode. "
+                "Set to 0 to only fetch them on demand."
+            ),
+            gr.Slider,
+            {"minimum": 0, "maximum": 20, "step": 1},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_shared_example_images",
+        shared.OptionInfo(
+            True,
+            "Link example images shared by several models to one file instead of downloading them again",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_preview_thumbnails",
+        shared.OptionInfo(
+            True,
+            "Create small WebP thumbnails next to downloaded previews and example images",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section
+        )
+    )
     shared.opts.add_option(
         "ch_nsfw_threshold",
         shared.OptionInfo(
@@ -296,6 +347,102 @@ def on_ui_settings():
             section=section)
     )
 
+    shared.opts.add_option(
+        "ch_dl_segments",
+        shared.OptionInfo(
+            4,
+            (
+                "Number of parallel connections used to download large model files. "
+                "Set to 1 to download over a single connection."
+            ),
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_dl_concurrency",
+        shared.OptionInfo(
+            2,
+            "Number of downloads the download queue runs at the same time",
+            gr.Slider,
+            {"minimum": 1, "maximum": 8, "step": 1},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_dl_model_bandwidth",
+        shared.OptionInfo(
+            0,
+            (
+                "Bandwidth limit in MiB/s shared by all model downloads. "
+                "Set to 0 for no limit."
+            ),
+            gr.Number,
+            {"interactive": True, "minimum": 0},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_dl_image_bandwidth",
+        shared.OptionInfo(
+            0,
+            (
+                "Bandwidth limit in MiB/s shared by all preview and example image downloads. "
+                "Set to 0 for no limit."
+            ),
+            gr.Number,
+            {"interactive": True, "minimum": 0},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_offline_mode",
+        shared.OptionInfo(
+            False,
+            (
+                "Offline mode. Civitai lookups are answered only from the local cache "
+                "and misses are queued to be resolved later. No network requests are made."
+            ),
+            gr.Checkbox,
+            {"interactive": True},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_update_check_interval",
+        shared.OptionInfo(
+            0,
+            (
+                "Check for new model versions in the background every N hours. "
+                "Set to 0 to disable."
+            ),
+            gr.Slider,
+            {"minimum": 0, "maximum": 168, "step": 1},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_update_check_types",
+        shared.OptionInfo(
+            update_scheduler.DEFAULT_MODEL_TYPES,
+            "Model types to check for new versions in the background",
+            gr.CheckboxGroup,
+            {"choices": list(model.folders)},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "ch_update_check_budget",
+        shared.OptionInfo(
+            120,
+            "Maximum Civitai requests per hour for background update checks",
+            gr.Slider,
+            {"minimum": 10, "maximum": 3600, "step": 10},
+            section=section
+        )
+    )
+
     if dynamic_args:
         shared.opts.add_option(
             "ch_image_metadata",
@@ -311,8 +458,18 @@ def on_ui_settings():
         "ch_proxy",
         update_proxy
     )
+    shared.opts.onchange(
+        "ch_dl_model_bandwidth",
+        bandwidth.update_limits
+    )
+    shared.opts.onchange(
+        "ch_dl_image_bandwidth",
+        bandwidth.update_limits
+    )
 
 util.GRADIO_FALLBACK = not (parse_version(gr.__version__) > parse_version("3.42.0"))
 
 script_callbacks.on_ui_settings(on_ui_settings)
 script_callbacks.on_ui_tabs(on_ui_tabs)
+script_callbacks.on_app_started(update_scheduler.on_app_started)
+script_callbacks.on_app_started(dl_queue.on_app_started)
@@ -1,10 +1,9 @@
-import json
 import re
-import os
 from pathlib import Path
 from functools import reduce
 
 from ch_lib import util
+from ch_lib import image_resources
 from modules import script_callbacks, extra_networks, prompt_parser, processing, sd_models, infotext_utils
 import networks # extensions-builtin\sd_forge_lora\networks.py
 try:
@@ -18,6 +17,51 @@ re_prompt = re.compile(r"^(?!.+\sneg(?:ative)?)(.+\s)prompt(\s\S+)?$")
 re_negative_prompt = re.compile(r"^(.+\s)neg(?:ative)?\sprompt(\s\S+)?$")
 re_checkpoint = re.compile(r"^(?!Hires).+\scheckpoint(?:\s\S+)?$")
 
+def dedupe_keep_last(items):
+    unique = {}
+    for item in items:
+        unique.pop(item, None)
+        unique[item] = None
+    return list(unique)
+
+def is_batch_parameter(key):
+    return (
+        re_prompt.search(key) is not None
+        or re_negative_prompt.search(key) is not None
+        or re_checkpoint.search(key) is not None
+        or "steps" in key.lower()
+    )
+
+def get_network_key(network_data):
+    return tuple(
+        (name, tuple(tuple(network_params.positional) for network_params in params_list))
+        for name, params_list in network_data.items()
+    )
+
+def get_batch_key(sd_processing, generation_parameters, embedding_index):
+    # Everything the resource list is computed from. Images of a batch only
+    # differ here if they have their own prompts.
+    hires = None
+    if isinstance(sd_processing, processing.StableDiffusionProcessingTxt2Img) and sd_processing.enable_hr:
+        hires = (
+            sd_processing.hr_checkpoint_name,
+            str(sd_processing.hr_prompt),
+            str(sd_processing.hr_negative_prompt),
+            sd_processing.hr_second_pass_steps,
+            get_network_key(sd_processing.hr_extra_network_data),
+        )
+
+    return (
+        sd_processing.sd_model_name,
+        str(sd_processing.prompt),
+        str(sd_processing.negative_prompt),
+        sd_processing.steps,
+        get_network_key(sd_processing.extra_network_data),
+        hires,
+        tuple((key, str(value)) for key, value in generation_parameters.items() if is_batch_parameter(key)),
+        id(embedding_index),
+    )
+
 def add_resource_metadata(params):
     if not (dynamic_args or comments):
         return
@@ -27,6 +71,25 @@ def add_resource_metadata(params):
 
     # StableDiffusionProcessing
     sd_processing = params.p
+
+    # Read prompt/generation data from other extensions, e.g., ADetailer, μDDetailer
+    generation_parameters = infotext_utils.parse_generation_parameters(params.pnginfo['parameters'])
+
+    # Get embedding file paths, cached until the embedding directory changes
+    embedding_index = image_resources.get_embedding_index(dynamic_args['embedding_dir'])
+
+    # Images of the same batch reuse the resource list computed for the first one
+    job_id = id(sd_processing)
+    batch_key = get_batch_key(sd_processing, generation_parameters, embedding_index)
+    civitai_resource_list = image_resources.get_batch_resources(job_id, batch_key)
+    if civitai_resource_list is None:
+        civitai_resource_list = collect_civitai_resources(sd_processing, generation_parameters, embedding_index)
+        image_resources.set_batch_resources(job_id, batch_key, civitai_resource_list)
+
+    if len(civitai_resource_list) > 0:
+        params.pnginfo['parameters'] += f", Civitai resources: [{','.join(civitai_resource_list)}]"
+
+def collect_civitai_resources(sd_processing, generation_parameters, embedding_index):
     # CheckpointInfo
     sd_checkpoint_info = sd_models.get_closet_checkpoint_match(sd_processing.sd_model_name)
 
@@ -34,21 +97,11 @@ def add_resource_metadata(params):
 
     def add_civitai_resource(base_file_path, weight=None, type_name=None):
         try:
-            # Read civitai metadata from previously generated info file
-            file_path = Path(base_file_path).with_suffix(".civitai.info")
-            with open(file_path, 'r') as file:
-                civitai_info = json.load(file)
-                resource_data = {}
-                resource_data["type"] = type_name if type_name is not None else civitai_info["model"]["type"].lower()
-                if resource_data["type"] in ["locon", "loha"]:
-                    resource_data["type"] = "lycoris"
-                if weight is not None:
-                    resource_data["weight"] = weight
-                resource_data["modelVersionId"] = civitai_info["id"]
-                resource_data["modelName"] = civitai_info["model"]["name"]
-                resource_data["modelVersionName"] = civitai_info["name"]
-                civitai_resource_list.append(resource_data)
+            # Read civitai metadata from previously generated info file, cached by mtime
+            record = image_resources.get_resource_record(base_file_path)
+            civitai_resource_list.append(image_resources.format_resource(record, weight, type_name))
         except FileNotFoundError:
+            file_path = Path(base_file_path).with_suffix(".civitai.info")
             util.printD(f"Warning: '{file_path}' not found. Did you forget to scan?")
         except Exception as e:
             util.printD(f"Civitai info error: {e}")
@@ -68,7 +121,6 @@ def add_resource_metadata(params):
     # TODO: img2img/upscale - add original image resources
 
     # Read prompt/generation data from other extensions, e.g., ADetailer, μDDetailer
-    generation_parameters = infotext_utils.parse_generation_parameters(params.pnginfo['parameters'])
     for key, value in generation_parameters.items():
         prompt_match = re_prompt.search(key)
         negative_prompt_match = re_negative_prompt.search(key)
@@ -116,24 +168,16 @@ def add_resource_metadata(params):
         else:
             util.printD(f"Error: '{extra_network_name}' alias not found.")
 
-    # Get embedding file paths
-    embed_filepaths = {}
-    try:
-        for dirpath, _, filenames in os.walk(dynamic_args['embedding_dir'], followlinks=True):
-            for filename in filenames:
-                filepath = Path(dirpath) / filename
-                if filepath.stat().st_size != 0 and filepath.suffix.upper() in ['.BIN', '.PT', '.SAFETENSORS']:
-                    embed_filepaths[filepath.stem.strip().lower()] = filepath.absolute()
-    except Exception as e:
-        util.printD(f"Embedding directory error: {e}")
+    embed_filepaths = embedding_index["paths"]
 
     # Add textual inversion embed metadata
     if len(embed_filepaths) > 0:
         embed_weights = {}
         try:
-            embed_regex = re.compile(r"(?:^|[\s,.])(" + '|'.join(re.escape(embed_name) for embed_name in embed_filepaths.keys()) + r")(?:$|[\s,.])", re.IGNORECASE | re.MULTILINE)
-            
-            for prompt, steps, is_positive in prompt_list:
+            embed_matcher = embedding_index["matcher"]
+
+            # Later occurrences win, so duplicates are dropped keeping the last one
+            for prompt, steps, is_positive in dedupe_keep_last(map(tuple, prompt_list)):
                 # parse all special prompt rules
                 comments_stripped = comments.strip_comments(prompt).strip()
                 extra_networks_stripped, _ = extra_networks.parse_prompt(comments_stripped)
@@ -142,13 +186,17 @@ def add_resource_metadata(params):
                 else:
                     prompt_flat_list = [extra_networks_stripped]
                 prompt_edit_schedule = prompt_parser.get_learned_conditioning_prompt_schedules(prompt_flat_list, steps)
-                prompts = [text for step, text in reduce(lambda list1, list2: list1 + list2, prompt_edit_schedule)]
-                for scheduled_prompt in prompts:
-                    # calculate attention weights
-                    for text, weight in prompt_parser.parse_prompt_attention(scheduled_prompt):
-                        for match in embed_regex.findall(text):
-                            # store final weight of embedding in dictionary
-                            embed_weights[match.lower()] = weight
+                prompts = dedupe_keep_last(text for step, text in reduce(lambda list1, list2: list1 + list2, prompt_edit_schedule))
+                # calculate attention weights
+                fragments = dedupe_keep_last(
+                    (text, weight)
+                    for scheduled_prompt in prompts
+                    for text, weight in prompt_parser.parse_prompt_attention(scheduled_prompt)
+                )
+                for text, weight in fragments:
+                    for match in embed_matcher.findall(text):
+                        # store final weight of embedding in dictionary
+                        embed_weights[match] = weight
         except Exception as e:
             util.printD(f"Error parsing prompt for embeddings: {e}")
 
@@ -156,7 +204,6 @@ def add_resource_metadata(params):
         for embed_name, weight in embed_weights.items():
             add_civitai_resource(embed_filepaths[embed_name], weight, "embed")
 
-    if len(civitai_resource_list) > 0:
-        params.pnginfo['parameters'] += f", Civitai resources: {json.dumps(civitai_resource_list, separators=(',', ':'))}"
+    return civitai_resource_list
 
 script_callbacks.on_before_image_saved(add_resource_metadata)